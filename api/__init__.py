@@ -1,27 +1,74 @@
-from config import Config
-from flask import Flask
-from flask_httpauth import HTTPBasicAuth
-from flask_restful import Api
-from flask_sqlalchemy import SQLAlchemy
+"""
+Books wishlist API
+`import api` only defines create_app() and startup(). The Flask app and its extensions (in
+api.core) and every resource are loaded by create_app(), which runs on the first access to app,
+api, db, cache or the auth objects (a module __getattr__), so tools that don't serve requests
+don't pay for them.
+Schema creation and warm-up are the separate startup() phase, which the servers run before
+taking requests.
+"""
 
 import os
+import threading
 basedir = os.path.abspath(os.path.dirname(__file__) + '/..')
 
-# Initialize app
-app = Flask(__name__)
-app.config.from_object(Config)
-api = Api(app, prefix='/api')
-auth = HTTPBasicAuth()
+# Module attributes defined by create_app(), from api.core
+app_attributes = ('app', 'api', 'basic_auth', 'token_auth', 'auth', 'db', 'cache')
+app_lock = threading.RLock()
 
-# Use separate (temporary) database for testing
-if app.config['TESTING']:
-    app.config['DATABASE'] = 'test_' + app.config['DATABASE']
+# Create the app and load its resources, once per process, and return it
+# There is a single app per process: the resource modules register on it when imported
+def create_app():
+    with app_lock:
+        if 'app' in globals():
+            return globals()['app']
+
+        from . import core
+        from . import views, models, migrations, commands, metrics, shards, limits
+
+        # In case the app is served without startup() having run, e.g. by `flask run`
+        @core.app.before_request
+        def ensure_schema():
+            if not schema_ready:
+                create_tables()
+
+        # Set last: their presence marks the app as created
+        globals().update((name, getattr(core, name)) for name in app_attributes)
+        return core.app
+
+def __getattr__(name):
+    if name in app_attributes:
+        create_app()
+        return globals()[name]
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+# Create or upgrade the schema, once per process
+# The production server does this in the master, so forked workers skip it
+schema_ready = False
 
-# Initialize database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, app.config['DATABASE'])
-db = SQLAlchemy(app)
-@app.before_first_request
 def create_tables():
-    db.create_all()
+    global schema_ready
+    create_app()
+    from .core import db
+    from . import migrations, shards
+    with app_lock:
+        if not schema_ready:
+            migrations.upgrade(db.engine)
+            db.create_all()
+            shards.create_tables()
+            schema_ready = True
 
-from . import views, models
+# Startup phase: create the app and schema and do the work the first requests would otherwise
+# wait for, i.e. load the catalog snapshot, configure the ORM mappers and open a database connection
+def startup():
+    create_app()
+    from sqlalchemy.orm import configure_mappers
+    from .core import app, db
+    from . import catalog
+    with app.app_context():
+        create_tables()
+        catalog.current()
+        configure_mappers()
+        with db.engine.connect():
+            pass
+    return app
@@ -0,0 +1,429 @@
+"""
+ASGI entry point with async handlers for the most frequent requests
+Reading users, books and wishlists and adding users are answered by coroutines on an
+aiosqlite connection pool, with password hashing run in a thread pool. Every other request,
+including nearly every error response, is handed to the Flask app in a worker thread, so responses
+are the same as the WSGI app's. The handlers apply the same rate limits and admission control
+as the Flask app (see limits.py). With SHARD_COUNT > 1 only book reads are handled here.
+Serve it with `uvicorn books_wishlist_asgi:application`.
+"""
+
+from .core import app, cache
+from . import compression, limits, serializers, startup
+from .views import timestamp
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy.engine.url import make_url
+from urllib.parse import parse_qs
+from werkzeug.http import generate_etag, http_date, is_resource_modified, parse_etags
+from werkzeug.security import generate_password_hash
+import asyncio
+import json
+import re
+import sqlite3
+import time
+
+try:
+    import aiosqlite
+    from a2wsgi import WSGIMiddleware
+except ImportError as e:
+    raise ImportError('The ASGI entry point requires aiosqlite and a2wsgi (pip install aiosqlite a2wsgi uvicorn)') from e
+
+book_columns = 'books.isbn, books.title, books.author, books.pub_date'
+user_columns = 'users.id, users.first_name, users.last_name, users.email'
+user_fields = ('first_name', 'last_name', 'email', 'password')
+
+def parse_date(value):
+    return value and datetime.strptime(value, '%Y-%m-%d').date()
+
+def parse_datetime(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+def book_dict(row):
+    return serializers.book_dict((row[0], row[1], row[2], parse_date(row[3])))
+
+class Database(object):
+    """
+    aiosqlite connections to the app's database
+    Writes share one connection; reads take one of <read_pool_size> query-only connections.
+    """
+
+    def __init__(self, path, pragmas, read_pool_size):
+        self.path = path
+        self.pragmas = pragmas
+        self.read_pool_size = read_pool_size
+        self.writer = None
+        self.readers = None
+        self.write_lock = asyncio.Lock()
+
+    async def connect(self, pragmas):
+        connection = await aiosqlite.connect(self.path)
+        for name, value in pragmas.items():
+            await connection.execute('PRAGMA %s = %s' % (name, value))
+        return connection
+
+    async def open(self):
+        self.writer = await self.connect(self.pragmas)
+        self.readers = asyncio.Queue()
+        for _ in range(max(1, self.read_pool_size)):
+            self.readers.put_nowait(await self.connect(dict(self.pragmas, query_only='ON')))
+
+    async def close(self):
+        if self.writer is not None:
+            await self.writer.close()
+            while not self.readers.empty():
+                await self.readers.get_nowait().close()
+        self.writer = self.readers = None
+
+    async def fetchall(self, sql, *parameters):
+        connection = await self.readers.get()
+        try:
+            async with connection.execute(sql, parameters) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self.readers.put_nowait(connection)
+
+    async def fetchone(self, sql, *parameters):
+        rows = await self.fetchall(sql, *parameters)
+        return rows[0] if rows else None
+
+    # Run one statement in its own transaction and return the new row ID
+    async def insert(self, sql, *parameters):
+        async with self.write_lock:
+            try:
+                cursor = await self.writer.execute(sql, parameters)
+                await self.writer.commit()
+            except sqlite3.Error:
+                await self.writer.rollback()
+                raise
+            return cursor.lastrowid
+
+class Request(object):
+    """
+    The parts of an ASGI HTTP scope the handlers use
+    """
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1'),
+            keep_blank_values=True).items()}
+        self.headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = None
+
+    async def read_body(self):
+        if self.body is None:
+            chunks = []
+            while True:
+                message = await self.receive()
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            self.body = b''.join(chunks)
+        return self.body
+
+    # Receive callable for the WSGI app, replaying a body that was already read
+    def replay(self):
+        if self.body is None:
+            return self.receive
+        messages = [{'type': 'http.request', 'body': self.body, 'more_body': False}]
+        async def receive():
+            if messages:
+                return messages.pop()
+            return await self.receive()
+        return receive
+
+    # Whether the client's If-None-Match/If-Modified-Since allow a 304 for <etag> and <last_modified>
+    def not_modified(self, etag, last_modified=None):
+        environ = {'REQUEST_METHOD': self.method}
+        for name in ('if-none-match', 'if-modified-since'):
+            if name in self.headers:
+                environ['HTTP_' + name.upper().replace('-', '_')] = self.headers[name]
+        return not is_resource_modified(environ, etag, last_modified=last_modified)
+
+def encode(data, status):
+    with app.app_context():
+        return serializers.output_json(data, status).get_data()
+
+# Return (status, headers, body) of an error response with extra <headers>
+def error_response(request, data, status, headers):
+    status, response_headers, body = json_response(request, data, status)
+    response_headers.update(headers)
+    return status, response_headers, body
+
+def json_response(request, data, status=200, etag=None, last_modified=None):
+    """
+    Return (status, headers, body) as the Flask app would send them
+    <etag> defaults to a hash of the body, as add_etag() does for 200 GET responses.
+    """
+    body = encode(data, status)
+    if status != 200 or request.method != 'GET':
+        return status, {'Content-Type': 'application/json'}, body
+
+    etag = etag or generate_etag(body)
+    if last_modified is not None:
+        last_modified = datetime.utcfromtimestamp(last_modified).replace(microsecond=0)
+    if request.not_modified(etag, last_modified):
+        return not_modified(etag)
+
+    headers = {'Content-Type': 'application/json', 'ETag': '"%s"' % etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return 200, headers, compression.compress_body(request.headers.get('accept-encoding'), headers, body)
+
+def not_modified(etag):
+    return 304, {'ETag': '"%s"' % etag}, b''
+
+class Application(object):
+    """
+    ASGI application serving the API
+    Handlers return None to pass a request on to the Flask app unchanged.
+    """
+
+    def __init__(self, flask_app, threads=10):
+        url = make_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+        self.db = Database(url.database, flask_app.config['SQLITE_PRAGMAS'], flask_app.config['SQLITE_READ_POOL_SIZE'])
+        self.executor = ThreadPoolExecutor(threads)
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        self.started = None
+        # (method, path, handler, Flask endpoint)
+        self.routes = [
+            ('GET', re.compile(r'/api/users$'), self.get_users, 'users'),
+            ('POST', re.compile(r'/api/users$'), self.post_user, 'users'),
+            ('GET', re.compile(r'/api/users/(\d+)$'), self.get_user, 'user'),
+            ('GET', re.compile(r'/api/books$'), self.get_books, 'books'),
+            ('GET', re.compile(r'/api/books/(\d+)$'), self.get_book, 'book'),
+            ('GET', re.compile(r'/api/users/(\d+)/books$'), self.get_wishlist, 'user books list'),
+            ('GET', re.compile(r'/api/books/([^/]+)/users$'), self.get_book_users, 'book users list')
+        ]
+        # Users and wishlists are spread over the shards, which only the Flask app routes to
+        if flask_app.config['SHARD_COUNT'] > 1:
+            self.routes = [route for route in self.routes if route[2] in (self.get_books, self.get_book)]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return await self.wsgi(scope, receive, send)
+
+        request = Request(scope, receive)
+        response = None
+        for method, pattern, handler, endpoint in self.routes:
+            match = pattern.match(request.path)
+            if match and request.method == method:
+                await self.startup()
+                response = await self.limited(request, endpoint, handler, *match.groups())
+                break
+        if response is None:
+            return await self.wsgi(scope, request.replay(), send)
+
+        status, headers, body = response
+        if status != 304:
+            headers['Content-Length'] = str(len(body))
+        await send({'type': 'http.response.start', 'status': status,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # Run <handler> if the client has tokens left for it and the process admits it, as
+    # limits.limit_request() does for Flask
+    async def limited(self, request, endpoint, handler, *args):
+        key, cost = None, 0
+        if app.config['RATE_LIMIT_ENABLED']:
+            authorization = request.headers.get('authorization')
+            key = limits.client_key(authorization, (request.scope.get('client') or (None,))[0])
+            cost = limits.request_cost(endpoint, request.method, request.args, authorization)
+            wait = limits.take(key, cost)
+            if wait:
+                return error_response(request, *limits.too_many_requests(wait))
+        admitted_at = None
+        if app.config['ADMISSION_ENABLED']:
+            if not limits.admission.enter(app.config['ADMISSION_MAX_IN_FLIGHT'], app.config['ADMISSION_MAX_LATENCY']):
+                return error_response(request, *limits.server_busy())
+            admitted_at = time.perf_counter()
+
+        response = None
+        try:
+            response = await handler(request, *args)
+        finally:
+            # Requests passed on to the Flask app are admitted and timed there
+            if admitted_at is not None:
+                limits.admission.leave(time.perf_counter() - admitted_at if response is not None else None)
+        if response is None and cost:
+            # The Flask app charges the request itself
+            limits.take(key, -cost)
+        return response
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Run the app's startup phase and open the connection pool, once
+    async def startup(self):
+        if self.started is None:
+            self.started = asyncio.ensure_future(self.open())
+        await asyncio.shield(self.started)
+
+    async def open(self):
+        await asyncio.get_event_loop().run_in_executor(self.executor, startup)
+        await self.db.open()
+
+    async def close(self):
+        await self.db.close()
+        self.started = None
+
+    # Parse ?limit= and ?after= like page_args(), or return None if Flask should answer
+    def page_args(self, request, key_type):
+        if set(request.args) - {'limit', 'after'}:
+            return None
+        try:
+            limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+            after = request.args.get('after')
+            after = after if after is None else key_type(after)
+        except ValueError:
+            return None
+        if limit < 1:
+            return None
+        return min(limit, app.config['MAX_PAGE_SIZE']), after
+
+    async def paginate(self, request, name, table, columns, key, key_type, to_dict):
+        args = self.page_args(request, key_type)
+        if args is None:
+            return None
+        if not request.args:
+            rows = await self.db.fetchall('SELECT %s FROM %s' % (columns, table))
+            return json_response(request, {name: list(map(to_dict, rows))})
+
+        limit, after = args
+        where = '' if after is None else ' WHERE %s > ?' % key
+        rows = await self.db.fetchall('SELECT %s FROM %s%s ORDER BY %s LIMIT ?' % (columns, table, where, key),
+            *([] if after is None else [after]) + [limit + 1])
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return json_response(request, {name: list(map(to_dict, rows)), 'next': next_cursor})
+
+    async def get_users(self, request):
+        return await self.paginate(request, 'users', 'users', user_columns, 'users.id', int, serializers.user_dict)
+
+    async def get_books(self, request):
+        return await self.paginate(request, 'books', 'books', book_columns, 'books.isbn', str, book_dict)
+
+    # Add a user, hashing the password in the thread pool
+    # Anything Flask would reject (missing fields, duplicate email) is left to Flask
+    async def post_user(self, request):
+        content_type = request.headers.get('content-type', '').split(';')[0].strip()
+        body = await request.read_body()
+        if content_type == 'application/json':
+            try:
+                data = json.loads(body.decode('UTF-8'))
+            except ValueError:
+                return None
+        elif content_type == 'application/x-www-form-urlencoded':
+            data = {name: values[0] for name, values in parse_qs(body.decode('UTF-8'), keep_blank_values=True).items()}
+        else:
+            return None
+        if not isinstance(data, dict) or request.args:
+            return None
+        if not all(isinstance(data.get(field), str) for field in user_fields):
+            return None
+        if await self.db.fetchone('SELECT 1 FROM users WHERE email = ?', data['email']) is not None:
+            return None
+
+        password_hash = await asyncio.get_event_loop().run_in_executor(self.executor,
+            generate_password_hash, data['password'])
+        try:
+            user_id = await self.db.insert('INSERT INTO users (first_name, last_name, email, password_hash, '
+                'wishlist_version, wishlist_updated_at) VALUES (?, ?, ?, ?, 1, ?)', data['first_name'], data['last_name'],
+                data['email'], password_hash, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'))
+        except sqlite3.IntegrityError:
+            # Another request added a user with this email since it was checked
+            return json_response(request, { "message": "User with this email already exists" }, 409)
+        user = serializers.user_dict((user_id, data['first_name'], data['last_name'], data['email']))
+        return json_response(request, {'user': user}, 201)
+
+    async def get_user(self, request, id):
+        id = int(id)
+        key = 'user:%d' % id
+        user = cache.get(key)
+        if user is None:
+            row = await self.db.fetchone('SELECT %s FROM users WHERE id = ?' % user_columns, id)
+            if row is None:
+                return None
+            user = serializers.user_dict(row)
+            cache.set(key, user)
+        return json_response(request, {'user': user})
+
+    # Same as conditional_get(): a cache miss with If-None-Match only checks the version
+    async def conditional_get(self, request, name, key, etag, load, load_version):
+        entry = cache.get(key)
+        if entry is None:
+            if 'if-none-match' in request.headers:
+                version = await load_version()
+                if version is not None and parse_etags(request.headers['if-none-match']).contains_weak('%s-%s' % (etag, version)):
+                    return not_modified('%s-%s' % (etag, version))
+            entry = await load()
+            if entry is None:
+                return None
+            cache.set(key, entry)
+
+        body, version, modified = entry
+        return json_response(request, {name: body}, etag='%s-%s' % (etag, version), last_modified=modified)
+
+    async def get_book(self, request, isbn):
+        isbn = str(int(isbn))
+
+        async def load():
+            row = await self.db.fetchone('SELECT %s, books.version, books.updated_at FROM books WHERE isbn = ?'
+                % book_columns, isbn)
+            return row and [book_dict(row), row[4], timestamp(parse_datetime(row[5]))]
+
+        async def load_version():
+            row = await self.db.fetchone('SELECT version FROM books WHERE isbn = ?', isbn)
+            return row and row[0]
+
+        return await self.conditional_get(request, 'book', 'book:%s' % isbn, 'book-%s' % isbn, load, load_version)
+
+    async def get_wishlist(self, request, id):
+        id = int(id)
+
+        async def load():
+            user = await self.db.fetchone('SELECT wishlist_version, wishlist_updated_at FROM users WHERE id = ?', id)
+            if user is None:
+                return None
+            rows = await self.db.fetchall('SELECT %s FROM books JOIN user_books ON user_books.isbn = books.isbn '
+                'WHERE user_books.user_id = ?' % book_columns, id)
+            return [list(map(book_dict, rows)), user[0], timestamp(parse_datetime(user[1]))]
+
+        async def load_version():
+            row = await self.db.fetchone('SELECT wishlist_version FROM users WHERE id = ?', id)
+            return row and row[0]
+
+        return await self.conditional_get(request, 'books', 'wishlist:%d' % id, 'wishlist-%d' % id, load, load_version)
+
+    async def get_book_users(self, request, isbn):
+        if request.args:
+            return None
+        key = 'book_users:' + isbn
+        users = cache.get(key)
+        if users is None:
+            if await self.db.fetchone('SELECT 1 FROM books WHERE isbn = ?', isbn) is None:
+                return None
+            rows = await self.db.fetchall('SELECT %s FROM users JOIN user_books ON user_books.user_id = users.id '
+                'WHERE user_books.isbn = ?' % user_columns, isbn)
+            users = list(map(serializers.user_dict, rows))
+            cache.set(key, users)
+        return json_response(request, {'users': users})
+
+application = Application(app, threads=app.config['ASGI_THREADS'])
@@ -0,0 +1,192 @@
+"""
+Bulk import of books and wishlist entries
+Rows are read from a JSON array, NDJSON or CSV stream and written in batched multi-row
+inserts, committing every BULK_COMMIT_SIZE rows instead of once per book.
+"""
+
+from itertools import islice
+from .core import app, db, cache
+from . import shards
+from .models import BookModel, UserModel, changes, user_books, touch_wishlists, reconcile_wish_counts
+from .schemas import parse_date, normalize_isbn, date_format_error, isbn_format_error
+import csv
+import json
+
+book_fields = ('isbn', 'title', 'author', 'pub_date')
+
+# SQLite builds before 3.32 allow at most 999 bound parameters per statement
+max_params = 500
+
+# Read import rows from a text stream in the given format (json, ndjson or csv)
+def read_rows(stream, fmt):
+    if fmt == 'json':
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError('JSON import must be an array of books')
+        return iter(rows)
+    if fmt == 'ndjson':
+        return (json.loads(line) for line in stream if line.strip())
+    if fmt == 'csv':
+        return csv.DictReader(stream)
+    raise ValueError('Import format must be json, ndjson or csv')
+
+def parse_user_id(value):
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return False
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+# Return {isbn: hash((title, author, pub_date))} for the books in <isbns> that are already stored
+def existing_books(isbns):
+    table = BookModel.__table__
+    found = {}
+    for chunk in chunks(isbns, max_params):
+        query = db.select([table.c.isbn, table.c.title, table.c.author, table.c.pub_date]).where(table.c.isbn.in_(chunk))
+        for isbn, title, author, pub_date in db.session.execute(query):
+            found[isbn] = hash((title, author, pub_date))
+    return found
+
+def existing_users(user_ids):
+    found = set()
+    for shard, shard_user_ids in shards.group(user_ids).items():
+        with shards.using(shard):
+            for chunk in chunks(shard_user_ids, max_params):
+                query = db.select([UserModel.__table__.c.id]).where(UserModel.__table__.c.id.in_(chunk))
+                found.update(user_id for user_id, in db.session.execute(query))
+    return found
+
+class BookImport(object):
+    """
+    Bulk book import
+    Books already in the import or database are deduplicated by ISBN; a repeated row for
+    an identical book only adds its wishlist link. Only a hash of each book's attributes is
+    kept per ISBN so multi-million row imports fit in memory. Each rejected row is reported
+    with its 1-based position in the input.
+    """
+
+    def __init__(self, allowed_user_id=None):
+        self.allowed_user_id = allowed_user_id
+        self.seen = {}
+        self.imported = 0
+        self.linked = 0
+        self.error_count = 0
+        self.errors = []
+        self.stale = set()
+
+    def error(self, row, isbn, message):
+        self.error_count += 1
+        if len(self.errors) < app.config['BULK_MAX_ERRORS']:
+            self.errors.append({'row': row, 'isbn': isbn, 'message': message})
+
+    def run(self, rows):
+        rows = enumerate(rows, 1)
+        batch_size = app.config['BULK_BATCH_SIZE']
+        uncommitted = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            self.write_batch(batch)
+            uncommitted += len(batch)
+            if uncommitted >= app.config['BULK_COMMIT_SIZE']:
+                self.commit()
+                uncommitted = 0
+        self.commit()
+        return self.report()
+
+    # Commit and drop cached wishlists that gained a book
+    def commit(self):
+        db.session.commit()
+        cache.delete(*self.stale)
+        self.stale.clear()
+
+    def validate(self, batch):
+        valid = []
+        for number, row in batch:
+            if not isinstance(row, dict):
+                self.error(number, None, 'Row must be an object')
+                continue
+            missing = [field for field in book_fields if not row.get(field)]
+            if missing:
+                self.error(number, row.get('isbn'), 'Missing ' + ', '.join(missing))
+                continue
+            valid.append((number, row))
+
+        # Parse the whole pub_date column in one pass
+        dates = list(map(parse_date, [row['pub_date'] for number, row in valid]))
+        user_ids = list(map(parse_user_id, [row.get('user_id') for number, row in valid]))
+
+        parsed = []
+        for (number, row), pub_date, user_id in zip(valid, dates, user_ids):
+            isbn = normalize_isbn(str(row['isbn']))
+            if isbn is None:
+                self.error(number, row['isbn'], isbn_format_error)
+            elif pub_date is None:
+                self.error(number, isbn, date_format_error)
+            elif user_id is False:
+                self.error(number, isbn, 'User ID (user_id) must be an integer')
+            elif user_id is not None and self.allowed_user_id is not None and user_id != self.allowed_user_id:
+                self.error(number, isbn, 'Users are only allowed to add books to their own wishlist')
+            else:
+                parsed.append((number, isbn, (str(row['title']), str(row['author']), pub_date), user_id))
+        return parsed
+
+    def write_batch(self, batch):
+        parsed = self.validate(batch)
+
+        new_isbns = list({isbn for number, isbn, book, user_id in parsed if isbn not in self.seen})
+        self.seen.update(existing_books(new_isbns))
+        known_users = existing_users(list({user_id for number, isbn, book, user_id in parsed if user_id is not None}))
+
+        books = []
+        links = []
+        for number, isbn, book, user_id in parsed:
+            stored = self.seen.get(isbn)
+            if stored is None:
+                self.seen[isbn] = hash(book)
+                books.append(dict(zip(book_fields, (isbn,) + book)))
+            elif stored != hash(book):
+                self.error(number, isbn, 'Different book with this ISBN already exists')
+                continue
+            if user_id is None:
+                continue
+            if user_id not in known_users:
+                self.error(number, isbn, 'User not found')
+            else:
+                links.append({'user_id': user_id, 'isbn': isbn})
+                self.stale.update(('wishlist:%d' % user_id, 'book_users:' + isbn))
+
+        if books:
+            db.session.execute(BookModel.__table__.insert(), books)
+            db.session.execute(changes.insert(), [{'kind': 'book', 'isbn': book['isbn'], 'user_id': None}
+                for book in books])
+            self.imported += len(books)
+        if links:
+            # Links that already existed are recorded too; replaying an add is harmless
+            db.session.execute(changes.insert(), [dict(link, kind='add') for link in links])
+            # Each user's links are written to their shard, after the main database (see shards.lock_main)
+            for shard, user_ids in shards.group({link['user_id'] for link in links}).items():
+                with shards.using(shard):
+                    shard_links = [link for link in links if shards.shard_for(link['user_id']) == shard]
+                    self.linked += db.session.execute(user_books.insert().prefix_with('OR IGNORE'), shard_links).rowcount
+                    touch_wishlists(user_ids)
+            # OR IGNORE skips links that already exist, so recount the linked books instead of adding
+            for isbns in chunks(list({link['isbn'] for link in links}), max_params):
+                reconcile_wish_counts(isbns)
+
+    def report(self):
+        return {
+            'imported': self.imported,
+            'linked': self.linked,
+            'error_count': self.error_count,
+            'errors': sorted(self.errors, key=lambda x: x['row'])
+        }
+
+def import_books(rows, allowed_user_id=None):
+    return BookImport(allowed_user_id).run(rows)
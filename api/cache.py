@@ -0,0 +1,166 @@
+"""
+Read-through cache for serialized books, users and wishlists
+Backends store JSON-compatible values under string keys and count hits, misses and evictions.
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import json
+import threading
+import time
+
+class CacheBackend(ABC):
+    """
+    Cache backend interface
+    get() returns None on a miss, so None itself can't be cached.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abstractmethod
+    def delete(self, *keys):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class NullCache(CacheBackend):
+    """
+    Backend that never stores anything, for CACHE_BACKEND = 'none'
+    """
+
+    name = 'none'
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+class LRUCache(CacheBackend):
+    """
+    In-process LRU backend
+    Holds at most <max_size> entries, each for at most <ttl> seconds. Expired entries
+    and entries pushed out by the size limit are both counted as evictions. A <max_size>
+    of 0 stores nothing.
+    """
+
+    name = 'lru'
+
+    def __init__(self, max_size=10000, ttl=300):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats['size'] = len(self.entries)
+        return stats
+
+class RedisCache(CacheBackend):
+    """
+    Backend for a Redis server or any stand-in with the same get/setex/delete/scan_iter commands
+    Values are stored as JSON under <prefix>; Redis expires and evicts entries itself.
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, ttl=300, prefix='books_wishlist:'):
+        super(RedisCache, self).__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+# Build the backend selected by CACHE_BACKEND ('lru', 'redis' or 'none')
+def create_cache(config):
+    backend = config['CACHE_BACKEND']
+    if backend == 'lru':
+        return LRUCache(config['CACHE_MAX_SIZE'], config['CACHE_TTL'])
+    if backend == 'redis':
+        import redis
+        return RedisCache(redis.StrictRedis.from_url(config['CACHE_REDIS_URL']), config['CACHE_TTL'])
+    if backend == 'none':
+        return NullCache()
+    raise ValueError('Unknown CACHE_BACKEND: %s' % backend)
@@ -0,0 +1,307 @@
+"""
+Compact read-side copy of the book catalog, enabled with CATALOG_ENABLED
+Books are stored column by column in a memory-mapped snapshot file (CATALOG_SNAPSHOT):
+ISBNs and titles as UTF-8 blobs with offset arrays, authors as indexes into an interned
+author list, publication dates as day ordinals, and an open-addressing hash table from ISBN
+to row. Rows are in ISBN order, so pages are read without sorting. Books written after
+the snapshot was taken are kept in a small overlay, refreshed from the 'book' entries of the change
+log (see feed.py) after every commit and at most CATALOG_REFRESH_INTERVAL seconds apart, so other
+processes' writes show up too. Change sequence numbers are assigned in commit order, so unlike
+timestamps they never let a transaction that committed late be skipped.
+Book, book list and batch book lookups are then answered without touching the database.
+"""
+
+from . import basedir
+from .core import app, db
+from .database import RoutingSession
+from .models import BookModel, changes
+from array import array
+from bisect import bisect_right, insort
+from datetime import date, datetime
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+magic = b'BWCAT002'
+# magic, row count, hash table size, author count, watermark (the last change sequence number
+# included), then the offset of each section
+header = struct.Struct('<8sQQQQ11Q')
+sections = ('isbn_offsets', 'isbns', 'title_offsets', 'titles', 'author_ids', 'author_offsets', 'authors',
+    'dates', 'versions', 'updated', 'table')
+# Typecodes of the array sections; the rest are UTF-8 blobs
+typecodes = {'isbn_offsets': 'Q', 'title_offsets': 'Q', 'author_ids': 'I', 'author_offsets': 'Q', 'dates': 'i',
+    'versions': 'I', 'updated': 'd', 'table': 'q'}
+
+epoch = datetime(1970, 1, 1)
+
+def to_timestamp(value):
+    return (value - epoch).total_seconds() if value is not None else 0.0
+
+# Sequence number of the last change logged, including any since pruned
+def last_change(connection):
+    return connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").scalar() or 0
+
+# Whether changes after <watermark> have been pruned from the log, so it can't tell which books changed since
+def pruned_since(connection, watermark):
+    first = connection.execute(db.select([db.func.min(changes.c.seq)]).where(changes.c.seq > watermark)).scalar()
+    return (first or last_change(connection) + 1) > watermark + 1
+
+def slot(key, mask):
+    return zlib.crc32(key) & mask
+
+def columns():
+    return (BookModel.isbn, BookModel.title, BookModel.author, BookModel.pub_date, BookModel.version,
+        BookModel.updated_at)
+
+def write_snapshot(path, connection):
+    """
+    Write every book to a snapshot file at <path>, replacing it atomically
+    Returns the number of books written.
+    """
+    isbn_offsets, isbns = array('Q', [0]), bytearray()
+    title_offsets, titles = array('Q', [0]), bytearray()
+    author_ids, author_index = array('I'), {}
+    dates, versions, updated = array('i'), array('I'), array('d')
+    # Read before the books, so books changed while they are read are read again on refresh
+    watermark = last_change(connection)
+
+    query = db.select(columns()).order_by(BookModel.isbn)
+    for isbn, title, author, pub_date, version, updated_at in connection.execution_options(stream_results=True).execute(query):
+        isbns += isbn.encode('UTF-8')
+        isbn_offsets.append(len(isbns))
+        titles += (title or '').encode('UTF-8')
+        title_offsets.append(len(titles))
+        author_ids.append(author_index.setdefault(author or '', len(author_index)))
+        dates.append(pub_date.toordinal() if pub_date else 0)
+        versions.append(version or 1)
+        updated.append(to_timestamp(updated_at))
+
+    count = len(author_ids)
+    size = 1
+    while size < count * 2:
+        size *= 2
+    table = array('q', [-1]) * size
+    for row in range(count):
+        position = slot(bytes(isbns[isbn_offsets[row]:isbn_offsets[row + 1]]), size - 1)
+        while table[position] >= 0:
+            position = (position + 1) & (size - 1)
+        table[position] = row
+
+    authors = list(author_index)
+    author_offsets, author_blob = array('Q', [0]), bytearray()
+    for author in authors:
+        author_blob += author.encode('UTF-8')
+        author_offsets.append(len(author_blob))
+
+    data = {'isbn_offsets': isbn_offsets, 'isbns': isbns, 'title_offsets': title_offsets, 'titles': titles,
+        'author_ids': author_ids, 'author_offsets': author_offsets, 'authors': author_blob, 'dates': dates,
+        'versions': versions, 'updated': updated, 'table': table}
+    # A unique name in the same directory, so processes writing snapshots at once don't clobber each other's
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(b'\0' * header.size)
+            offsets = []
+            for name in sections:
+                # Align every section to 8 bytes so arrays can be cast from the mapped file
+                f.write(b'\0' * (-f.tell() % 8))
+                offsets.append(f.tell())
+                f.write(data[name])
+            f.seek(0)
+            f.write(header.pack(magic, count, size, len(authors), watermark, *offsets))
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return count
+
+class Catalog(object):
+    """
+    Books from a snapshot file plus the books written since
+    Rows are (isbn, title, author, pub_date, version, updated_at timestamp) tuples.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (overlay, added): the overlay, and the ISBNs in it that aren't in the snapshot, in order
+        # refresh() swaps in new ones rather than changing them, so readers always see a matching pair
+        self.recent = ({}, [])
+        self.last_refresh = 0.0
+        self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        values = header.unpack_from(self.map)
+        if values[0] != magic:
+            raise ValueError('%s is not a catalog snapshot' % self.path)
+        self.count, size, author_count, watermark = values[1:5]
+        offsets = values[5:] + (len(self.map),)
+
+        for i, name in enumerate(sections):
+            section = view[offsets[i]:offsets[i + 1]]
+            if name in typecodes:
+                length = {'table': size, 'author_offsets': author_count + 1,
+                    'isbn_offsets': self.count + 1, 'title_offsets': self.count + 1}.get(name, self.count)
+                section = section[:length * struct.calcsize(typecodes[name])].cast(typecodes[name])
+            setattr(self, name, section)
+        self.mask = size - 1
+        self.author_names = [str(self.authors[self.author_offsets[i]:self.author_offsets[i + 1]], 'UTF-8')
+            for i in range(author_count)]
+        self.watermark = watermark
+
+    def isbn_at(self, row):
+        return bytes(self.isbns[self.isbn_offsets[row]:self.isbn_offsets[row + 1]])
+
+    def find(self, isbn):
+        key = isbn.encode('UTF-8')
+        position = slot(key, self.mask)
+        while True:
+            row = self.table[position]
+            if row < 0 or self.isbn_at(row) == key:
+                return row if row >= 0 else None
+            position = (position + 1) & self.mask
+
+    def row(self, row):
+        pub_date = self.dates[row]
+        return (self.isbn_at(row).decode('UTF-8'),
+            str(self.titles[self.title_offsets[row]:self.title_offsets[row + 1]], 'UTF-8'),
+            self.author_names[self.author_ids[row]],
+            date.fromordinal(pub_date) if pub_date else None,
+            self.versions[row],
+            self.updated[row])
+
+    # Return the row for <isbn>, or None if there's no such book
+    def get(self, isbn):
+        isbn = str(isbn)
+        row = self.recent[0].get(isbn)
+        if row is not None:
+            return row
+        row = self.find(isbn)
+        return self.row(row) if row is not None else None
+
+    # First position in the snapshot with an ISBN after <after>
+    def position_after(self, after):
+        key = after.encode('UTF-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.isbn_at(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Return up to <limit> rows (all if None) in ISBN order, starting after ISBN <after>
+    def page(self, limit=None, after=None):
+        position = self.position_after(after) if after is not None else 0
+        overlay, added = self.recent
+        next_added = bisect_right(added, after) if after is not None else 0
+        rows = []
+        while limit is None or len(rows) < limit:
+            isbn = self.isbn_at(position).decode('UTF-8') if position < self.count else None
+            if next_added < len(added) and (isbn is None or added[next_added] < isbn):
+                rows.append(overlay[added[next_added]])
+                next_added += 1
+            elif isbn is not None:
+                rows.append(overlay.get(isbn) or self.row(position))
+                position += 1
+            else:
+                break
+        return rows
+
+    # Read books changed since the last refresh into the overlay
+    # Returns False, leaving the catalog as it is, if the log no longer covers them (see rebuild())
+    def refresh(self, connection=None):
+        with self.lock:
+            self.last_refresh = time.time()
+            connection = connection or db.engine
+            # Read first, so changes committed while the books are read are read again next time
+            latest = last_change(connection)
+            if pruned_since(connection, self.watermark):
+                return False
+            query = db.select(columns()) \
+                .select_from(changes.join(BookModel.__table__, BookModel.isbn == changes.c.isbn)) \
+                .where(changes.c.kind == 'book').where(changes.c.seq > self.watermark)
+            overlay, added = dict(self.recent[0]), list(self.recent[1])
+            for isbn, title, author, pub_date, version, updated_at in connection.execute(query):
+                if isbn not in overlay and self.find(isbn) is None:
+                    insort(added, isbn)
+                overlay[isbn] = (isbn, title, author, pub_date, version, to_timestamp(updated_at))
+            self.recent = (overlay, added)
+            self.watermark = max(self.watermark, latest)
+            return True
+
+    def maybe_refresh(self):
+        if time.time() - self.last_refresh >= app.config['CATALOG_REFRESH_INTERVAL'] and not self.lock.locked():
+            return self.refresh()
+        return True
+
+catalog = None
+catalog_lock = threading.Lock()
+
+def snapshot_path():
+    return os.path.join(basedir, app.config['CATALOG_SNAPSHOT'])
+
+# Load the snapshot at <path>, or return None if it was written by another version
+def load(path):
+    try:
+        return Catalog(path)
+    except ValueError:
+        return None
+
+# Write a new snapshot to <path> and load it
+def build(path):
+    with db.engine.connect() as connection:
+        write_snapshot(path, connection)
+    books = Catalog(path)
+    books.refresh()
+    return books
+
+# Replace <stale> with a new snapshot, unless another thread already has
+# Only happens to a process that didn't refresh for longer than the log is kept
+def rebuild(stale):
+    global catalog
+    with catalog_lock:
+        if catalog is stale:
+            catalog = build(snapshot_path())
+
+# Return the catalog, loading it (and writing the snapshot if there is none) on first use,
+# or None if CATALOG_ENABLED is off
+def current():
+    global catalog
+    if not app.config['CATALOG_ENABLED']:
+        return None
+    if catalog is None:
+        with catalog_lock:
+            if catalog is None:
+                path = snapshot_path()
+                loaded = load(path) if os.path.exists(path) else None
+                # Write a new snapshot if there's none, it's in an old format or the log no longer covers it
+                if loaded is None or not loaded.refresh():
+                    loaded = build(path)
+                catalog = loaded
+    books = catalog
+    if not books.maybe_refresh():
+        rebuild(books)
+        books = catalog
+    return books
+
+# Forget the loaded catalog, e.g. after writing a new snapshot
+def reset():
+    global catalog
+    with catalog_lock:
+        catalog = None
+
+# Pick up this process's own writes as soon as they are committed
+@db.event.listens_for(RoutingSession, 'after_commit')
+def refresh_after_commit(session):
+    books = catalog
+    if books is not None and not books.refresh():
+        rebuild(books)
@@ -0,0 +1,61 @@
+from .core import app, db
+from . import catalog, create_tables, feed, search
+from .models import commit, reconcile_wish_counts
+from .bulk import read_rows, import_books
+from datetime import datetime, timedelta
+import click
+import json
+
+# Flask CLI commands, run with e.g. `flask import-books catalog.csv`
+
+@app.cli.command('import-books')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['json', 'ndjson', 'csv']),
+    help='Input format; defaults to the file extension')
+def import_books_command(source, fmt):
+    """Bulk import books and wishlist links from a JSON, NDJSON or CSV file."""
+    if fmt is None:
+        fmt = source.name.rsplit('.', 1)[-1].lower()
+    create_tables()
+    try:
+        report = import_books(read_rows(source, fmt))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(report))
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the book search index, e.g. after a VACUUM."""
+    create_tables()
+    with db.engine.begin() as connection:
+        if not search.has_fts5(connection):
+            raise click.ClickException('SQLite was built without FTS5; search falls back to LIKE matching')
+        search.create_index(connection)
+        search.rebuild_index(connection)
+    click.echo('Search index rebuilt')
+
+@app.cli.command('reconcile-wish-counts')
+def reconcile_wish_counts_command():
+    """Recount every book's wish_count from the wishlists, e.g. from a nightly cron job."""
+    create_tables()
+    corrected = reconcile_wish_counts()
+    commit()
+    click.echo('Corrected %d wish counts' % corrected)
+
+@app.cli.command('build-catalog')
+def build_catalog_command():
+    """Write a fresh snapshot of the in-memory book catalog (see CATALOG_ENABLED)."""
+    create_tables()
+    with db.engine.connect() as connection:
+        count = catalog.write_snapshot(catalog.snapshot_path(), connection)
+    catalog.reset()
+    click.echo('Wrote %d books to %s' % (count, catalog.snapshot_path()))
+
+@app.cli.command('prune-changes')
+@click.option('--days', default=30, show_default=True, help='Keep changes from this many days.')
+def prune_changes_command(days):
+    """Delete old entries from the /api/changes log; clients further behind must resync in full."""
+    create_tables()
+    pruned = feed.prune(datetime.utcnow() - timedelta(days=days))
+    commit()
+    click.echo('Pruned %d changes' % pruned)
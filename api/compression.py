@@ -0,0 +1,130 @@
+"""
+Negotiated response compression
+JSON responses are compressed with the codec the client prefers in Accept-Encoding among
+COMPRESSION_CODECS: zstd (requires zstandard), br (requires brotli) and gzip, skipping codecs
+that aren't installed. Buffered responses smaller than COMPRESSION_MIN_SIZE bytes are sent as
+they are. Streamed responses are compressed chunk by chunk as they are generated, so the whole
+body is never held in memory. Compressed responses carry a weak ETag, since the bytes differ
+from the identity encoding the ETag was computed from.
+"""
+
+from .core import app
+from flask import request
+from werkzeug.http import parse_accept_header
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressible = ('application/json', 'application/x-ndjson')
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+codecs = {'gzip': GzipCompressor}
+if brotli is not None:
+    codecs['br'] = BrotliCompressor
+if zstandard is not None:
+    codecs['zstd'] = ZstdCompressor
+
+def compressor(codec):
+    return codecs[codec](app.config['COMPRESSION_LEVELS'][codec])
+
+# Return the available codec with the highest quality in <accept_encodings> (a werkzeug Accept),
+# preferring earlier COMPRESSION_CODECS on ties, or None if the client accepts none of them
+def negotiate(accept_encodings):
+    best, best_quality = None, 0
+    for codec in app.config['COMPRESSION_CODECS']:
+        quality = accept_encodings.quality(codec)
+        if codec in codecs and quality > best_quality:
+            best, best_quality = codec, quality
+    return best
+
+def compress(codec, data):
+    c = compressor(codec)
+    return c.compress(data) + c.finish()
+
+def compress_chunks(codec, chunks):
+    c = compressor(codec)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.finish()
+
+def weak_etag(etag):
+    return etag if etag is None or etag.startswith('W/') else 'W/' + etag
+
+# Compress a (status, headers, body) response from the ASGI handlers, given the request's
+# Accept-Encoding header; returns the body to send
+def compress_body(accept_encoding, headers, body):
+    if not app.config['COMPRESSION_ENABLED'] or headers.get('Content-Type') not in compressible:
+        return body
+    headers['Vary'] = 'Accept-Encoding'
+    codec = negotiate(parse_accept_header(accept_encoding))
+    if codec is None or len(body) < app.config['COMPRESSION_MIN_SIZE']:
+        return body
+    headers['Content-Encoding'] = codec
+    if 'ETag' in headers:
+        headers['ETag'] = weak_etag(headers['ETag'])
+    return compress(codec, body)
+
+# Registered before views.add_etag, so it runs after it: ETags and 304s are worked out on
+# the uncompressed body
+@app.after_request
+def compress_response(response):
+    if not app.config['COMPRESSION_ENABLED'] or response.mimetype not in compressible \
+            or response.status_code < 200 or response.status_code in (204, 206, 304) \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    codec = negotiate(request.accept_encodings)
+    if codec is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(codec, response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(compress(codec, data))
+    response.headers['Content-Encoding'] = codec
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = weak_etag(response.headers['ETag'])
+    return response
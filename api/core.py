@@ -0,0 +1,32 @@
+"""
+The Flask app and its extensions
+The other modules import them from here rather than from the package, so any of them can be
+imported first; api.create_app() imports this module and then loads the resources.
+"""
+
+from . import basedir
+from .cache import create_cache
+from .database import SQLAlchemy
+from config import Config
+from flask import Flask
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from flask_restful import Api
+import os
+
+# Initialize app
+app = Flask('api')
+app.config.from_object(Config)
+api = Api(app, prefix='/api')
+# Write endpoints accept either HTTP basic auth or a bearer token from /api/token
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth('Bearer')
+auth = MultiAuth(basic_auth, token_auth)
+
+# Use separate (temporary) database for testing
+if app.config['TESTING']:
+    app.config['DATABASE'] = 'test_' + app.config['DATABASE']
+
+# Initialize database
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, app.config['DATABASE'])
+db = SQLAlchemy(app)
+cache = create_cache(app.config)
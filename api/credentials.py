@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import hashlib
+import hmac
+import threading
+import time
+
+class CredentialCache(object):
+    """
+    Bounded, TTL-based cache of recently verified HTTP basic auth credentials
+    Maps (email, HMAC-SHA256 of the password) to (user id, password hash) so that
+    repeat requests skip the PBKDF2 check. Plaintext passwords are never stored,
+    and an entry is only honoured while the user's password hash is unchanged.
+    """
+
+    def __init__(self, secret_key, max_size=1024, ttl=300):
+        self.secret_key = secret_key.encode('UTF-8')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, email, password):
+        message = (email + '\0' + password).encode('UTF-8')
+        return email, hmac.new(self.secret_key, message, hashlib.sha256).hexdigest()
+
+    # Return the cached user id if these credentials were verified against <password_hash>
+    def get(self, email, password, password_hash):
+        key = self.key(email, password)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user_id, cached_hash, expires = entry
+            if expires < time.time() or not hmac.compare_digest(cached_hash, password_hash):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user_id
+
+    # Remember credentials that were just verified against <password_hash>
+    def add(self, email, password, user_id, password_hash):
+        key = self.key(email, password)
+        with self.lock:
+            self.entries[key] = (user_id, password_hash, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class TokenSigner(object):
+    """
+    Issues and checks signed, short-lived bearer tokens
+    Tokens carry the user id and email and are verified with the app's SECRET_KEY
+    alone, so checking one needs neither password hashing nor a database lookup.
+    """
+
+    def __init__(self, secret_key, ttl=600):
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='auth-token')
+        self.ttl = ttl
+
+    def dumps(self, user):
+        return self.serializer.dumps({'id': user.id, 'email': user.email})
+
+    # Return the token payload, or None if the token is invalid or expired
+    def loads(self, token):
+        try:
+            return self.serializer.loads(token, max_age=self.ttl)
+        except BadSignature:
+            return None
@@ -0,0 +1,132 @@
+"""
+SQLite engine configuration
+Every new SQLite connection gets the SQLITE_PRAGMAS performance profile, file databases
+use a sized connection pool, and reads made while handling GET requests go through a
+separate read-only pool so they don't queue behind the single writer.
+Binds (the user shards, see api/shards.py) have the main database attached to each of their
+connections as "catalog", so queries routed to a bind can still use the shared tables. This is
+done by the same connect listener as the pragmas, so it covers every engine of a bind however
+Flask-SQLAlchemy creates it.
+"""
+
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession, get_state
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+import os
+import sqlite3
+import threading
+
+read_methods = ('GET', 'HEAD')
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+def set_query_only(dbapi_connection, connection_record):
+    apply_pragmas(dbapi_connection, {'query_only': 'ON'})
+
+# Path of the SQLite database file behind <url>, or None if it isn't one
+def database_file(url):
+    url = make_url(url)
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return os.path.abspath(url.database)
+
+# Attach the main database to connections to a bind's database file
+def attach_catalog(dbapi_connection, config):
+    main = database_file(config['SQLALCHEMY_DATABASE_URI'])
+    binds = {database_file(url) for url in (config['SQLALCHEMY_BINDS'] or {}).values()}
+    if main is None or not binds - {None, main}:
+        return
+    for seq, name, path in dbapi_connection.execute('PRAGMA database_list'):
+        if name == 'main' and path and os.path.abspath(path) in binds - {main}:
+            dbapi_connection.execute('ATTACH DATABASE ? AS catalog', (main,))
+            return
+
+# Bind key the current request or task is routed to (g.shard_bind, set by api.shards), or None for the main database
+def current_bind():
+    return g.get('shard_bind') if has_app_context() else None
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends queries made while handling GET/HEAD requests to the read-only pool
+    Flushes and everything outside a read request use the default (writer) engine.
+    Both are those of the current bind, if one has been selected.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        db = get_state(self.app).db
+        bind = current_bind()
+        if not self._flushing and has_request_context() and request.method in read_methods:
+            engine = db.get_read_engine(self.app, bind)
+            if engine is not None:
+                return engine
+        if bind is not None:
+            return db.get_engine(self.app, bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy with the SQLite performance profile from Config
+    SQLITE_PRAGMAS, SQLITE_POOL_SIZE, SQLITE_MAX_OVERFLOW and SQLITE_READ_POOL_SIZE
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.read_engines = {}
+        self.read_engines_lock = threading.Lock()
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+
+        @event.listens_for(Engine, 'connect')
+        def configure_connection(dbapi_connection, connection_record):
+            if isinstance(dbapi_connection, sqlite3.Connection):
+                apply_pragmas(dbapi_connection, app.config['SQLITE_PRAGMAS'])
+                attach_catalog(dbapi_connection, app.config)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    # Replace Flask-SQLAlchemy's NullPool for file databases with a sized QueuePool
+    def apply_driver_hacks(self, app, info, options):
+        rv = super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and options.get('poolclass') is not StaticPool and app.config['SQLITE_POOL_SIZE']:
+            options['poolclass'] = QueuePool
+            options['pool_size'] = app.config['SQLITE_POOL_SIZE']
+            options['max_overflow'] = app.config['SQLITE_MAX_OVERFLOW']
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return rv
+
+    # Return the read-only engine for the app's database (or <bind>), or None if reads share the writer's pool
+    def get_read_engine(self, app=None, bind=None):
+        app = self.get_app(app)
+        pool_size = app.config['SQLITE_READ_POOL_SIZE']
+        url = self.get_engine(app, bind).url
+        if not pool_size or url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+            return None
+
+        with self.read_engines_lock:
+            engine = self.read_engines.get(str(url))
+            if engine is None:
+                engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size,
+                    max_overflow=app.config['SQLITE_MAX_OVERFLOW'], connect_args={'check_same_thread': False})
+                event.listen(engine, 'connect', set_query_only)
+                self.read_engines[str(url)] = engine
+            return engine
+
+    # Close every pooled connection, e.g. before the database file is removed
+    def dispose_engines(self, app=None):
+        app = self.get_app(app)
+        self.get_engine(app).dispose()
+        for bind in app.config['SQLALCHEMY_BINDS'] or ():
+            self.get_engine(app, bind).dispose()
+        with self.read_engines_lock:
+            for engine in self.read_engines.values():
+                engine.dispose()
+            self.read_engines.clear()
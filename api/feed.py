@@ -0,0 +1,76 @@
+"""
+Incremental sync over the change log
+Every book and wishlist write appends to the changes table in its own transaction, so a client
+that remembers the last seq it has seen can fetch just the changes since then. Requests with
+?wait= long-poll: they are woken as soon as this process commits, and look again every
+CHANGES_POLL_INTERVAL seconds to see commits from other processes.
+"""
+
+from .core import app, db
+from . import serializers, shards
+from .database import RoutingSession
+from .models import BookModel, changes, user_books
+import threading
+import time
+
+condition = threading.Condition()
+
+@db.event.listens_for(RoutingSession, 'after_commit')
+def notify_waiters(session):
+    with condition:
+        condition.notify_all()
+
+def change_dict(row):
+    return {
+        'seq': row.seq,
+        'kind': row.kind,
+        'user_id': row.user_id,
+        'isbn': row.isbn,
+        'created_at': row.created_at.isoformat() + 'Z',
+        # Current details of the book, or None once it's no longer relevant
+        'book': serializers.book_dict((row.book_isbn, row.title, row.author, row.pub_date))
+            if row.kind != 'remove' and row.book_isbn is not None else None
+    }
+
+# Up to <limit> changes after seq <since>, oldest first
+# For <user_id>, only changes to their wishlist and to the books on it are returned, read
+# on the user's shard so their wishlist can be joined
+def read_changes(since, limit, user_id=None):
+    query = db.select([changes.c.seq, changes.c.kind, changes.c.user_id, changes.c.isbn, changes.c.created_at,
+        BookModel.isbn.label('book_isbn'), BookModel.title, BookModel.author, BookModel.pub_date]) \
+        .select_from(changes.outerjoin(BookModel.__table__, BookModel.isbn == changes.c.isbn)) \
+        .where(changes.c.seq > since)
+    if user_id is not None:
+        wishlist = db.select([user_books.c.isbn]).where(user_books.c.user_id == user_id)
+        query = query.where(db.or_(changes.c.user_id == user_id,
+            db.and_(changes.c.kind == 'book', changes.c.isbn.in_(wishlist))))
+    with shards.using(shards.shard_for(user_id) if user_id is not None else None):
+        return [change_dict(row) for row in db.session.execute(query.order_by(changes.c.seq).limit(limit))]
+
+# Like read_changes, but wait up to <wait> seconds for a change if there are none yet
+def wait_for_changes(since, limit, user_id=None, wait=0):
+    deadline = time.monotonic() + wait
+    while True:
+        rows = read_changes(since, limit, user_id)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+        # End the read transaction, so the next read sees new commits
+        db.session.rollback()
+        with condition:
+            condition.wait(min(remaining, app.config['CHANGES_POLL_INTERVAL']))
+
+# (oldest, head): the lowest and highest seq still in the log, or (None, 0) if it's empty
+# Separate subqueries, so SQLite answers each from the primary key instead of scanning the log
+def seq_range():
+    oldest = db.select([db.func.min(changes.c.seq)]).as_scalar()
+    head = db.select([db.func.max(changes.c.seq)]).as_scalar()
+    oldest, head = db.session.execute(db.select([oldest, head])).first()
+    return oldest, head or 0
+
+# Delete changes recorded before <cutoff>, always keeping the latest one so seq
+# numbering (and the check for pruned history) carries on. Returns how many were deleted.
+def prune(cutoff):
+    latest = db.select([db.func.max(changes.c.seq)]).as_scalar()
+    return db.session.execute(changes.delete().where(db.and_(changes.c.created_at < cutoff,
+        changes.c.seq < latest))).rowcount
@@ -0,0 +1,67 @@
+"""
+Idempotency-Key support for wishlist writes
+A client that retries a write with the same Idempotency-Key header gets the first attempt's
+response again, marked with Idempotent-Replayed: true, without the write being repeated.
+Results are kept per user, method and path for IDEMPOTENCY_TTL seconds, in Redis when
+CACHE_BACKEND is 'redis' (so every worker sees them) and in process otherwise.
+"""
+
+from .core import app
+from .cache import LRUCache, RedisCache
+from flask import g, request
+from functools import wraps
+import hashlib
+import threading
+
+def create_results(config):
+    if config['CACHE_BACKEND'] == 'redis':
+        import redis
+        return RedisCache(redis.StrictRedis.from_url(config['CACHE_REDIS_URL']), config['IDEMPOTENCY_TTL'],
+            prefix='books_wishlist:idempotency:')
+    return LRUCache(config['IDEMPOTENCY_CACHE_SIZE'], config['IDEMPOTENCY_TTL'])
+
+results = create_results(app.config)
+
+# Keys of requests being handled by this process, so a retry that arrives before the
+# first attempt has finished isn't run twice
+in_progress = set()
+in_progress_lock = threading.Lock()
+
+def fingerprint():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+# Replay the stored response for a repeated Idempotency-Key
+# Must be applied under auth.login_required, since keys are scoped to the authenticated user
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return { "message": "Idempotency-Key must be at most 255 characters" }, 400
+
+        key = '%s:%s:%s:%s' % (g.user_id, request.method, request.path, key)
+        body = fingerprint()
+        stored = results.get(key)
+        if stored is not None:
+            status, data, stored_body = stored
+            if stored_body != body:
+                return { "message": "Idempotency-Key was already used for a different request" }, 422
+            return data, status, {'Idempotent-Replayed': 'true'}
+
+        with in_progress_lock:
+            if key in in_progress:
+                return { "message": "A request with this Idempotency-Key is still in progress" }, 409
+            in_progress.add(key)
+        try:
+            response = f(*args, **kwargs)
+            data, status = response if isinstance(response, tuple) else (response, 200)
+            # Server errors aren't stored, so the client's retry runs the write again
+            if status < 500:
+                results.set(key, [status, data, body])
+            return response
+        finally:
+            with in_progress_lock:
+                in_progress.discard(key)
+    return wrapper
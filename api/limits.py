@@ -0,0 +1,178 @@
+"""
+Per-client rate limiting and admission control
+With RATE_LIMIT_ENABLED, each client (the user of a valid bearer token, otherwise the remote
+address) has a token bucket refilled at RATE_LIMIT_RATE tokens a second up to RATE_LIMIT_BURST.
+A request costs its endpoint's weight in RATE_LIMIT_COSTS; full (unpaginated) listings and
+requests carrying a password to check cost more. Clients out of tokens get 429 with Retry-After.
+Buckets are kept in anonymous shared memory created when the app is loaded, so the workers
+the production server forks from it share them.
+With ADMISSION_ENABLED, each process handles at most ADMISSION_MAX_IN_FLIGHT requests at once,
+and while its smoothed request latency is above ADMISSION_MAX_LATENCY seconds only admits a
+request when no other is in flight. Requests turned away get 503 with Retry-After. Latency is
+measured to the first byte, so streamed listings don't count the time spent sending them, and
+long-polls of /api/changes (which mostly wait) are neither admitted nor timed.
+"""
+
+from .core import app, api
+from .views import token_signer
+from flask import g, request
+import hashlib
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+
+# Endpoints that are never limited, so monitoring keeps working under load
+exempt = ('prometheus_metrics',)
+# Endpoints that wait for changes when given ?wait=
+long_polls = ('changes',)
+# Listings that return every row unless one of <paging_args> is given
+listings = ('users', 'books')
+paging_args = ('limit', 'after', 'id', 'q', 'author', 'published_after', 'published_before')
+# Weight of the latest request in the smoothed latency
+latency_smoothing = 0.2
+
+class BucketTable(object):
+    """
+    Token buckets in a fixed-size table of <slots> in shared memory
+    Keys are hashed into sets of <ways> slots; a key that isn't in its set takes over the
+    slot updated longest ago, so idle clients are forgotten first.
+    """
+
+    slot = struct.Struct('<Qdd')
+
+    def __init__(self, slots, ways=8):
+        self.ways = ways
+        self.sets = max(1, slots // ways)
+        self.memory = mmap.mmap(-1, self.sets * ways * self.slot.size)
+        self.lock = multiprocessing.Lock()
+
+    # Take <cost> tokens (or give them back, if negative) from <key>'s bucket, which is refilled
+    # at <rate> tokens a second up to <burst>. Returns 0 if they were taken, otherwise the
+    # number of seconds until there will be enough.
+    def take(self, key, cost, rate, burst):
+        digest = int.from_bytes(hashlib.blake2b(key.encode('UTF-8'), digest_size=8).digest(), 'little') or 1
+        first = (digest % self.sets) * self.ways
+        cost = min(cost, burst)
+        # A worker killed while holding the lock mustn't stop the others, so give up and let the request in
+        if not self.lock.acquire(timeout=0.1):
+            return 0
+        try:
+            now = time.monotonic()
+            position, tokens, oldest = None, burst, None
+            for index in range(first, first + self.ways):
+                stored, stored_tokens, updated = self.slot.unpack_from(self.memory, index * self.slot.size)
+                if stored == digest:
+                    position, tokens = index, min(burst, stored_tokens + (now - updated) * rate)
+                    break
+                if oldest is None or updated < oldest[1]:
+                    oldest = (index, updated)
+            if position is None:
+                position = oldest[0]
+
+            wait = (cost - tokens) / rate if tokens < cost else 0
+            if not wait:
+                tokens = min(burst, tokens - cost)
+            self.slot.pack_into(self.memory, position * self.slot.size, digest, tokens, now)
+            return wait
+        finally:
+            self.lock.release()
+
+class Admission(object):
+    """
+    Count of requests in flight in this process and their smoothed latency
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = 0.0
+        self.shed = 0
+
+    # Admit a request, returning False if it should be turned away
+    def enter(self, max_in_flight, max_latency):
+        with self.lock:
+            if self.in_flight >= max_in_flight or (self.in_flight and self.latency > max_latency):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    # Release a request that took <duration> seconds, or None to leave it out of the latency
+    def leave(self, duration=None):
+        with self.lock:
+            self.in_flight -= 1
+            if duration is not None:
+                self.latency += (duration - self.latency) * latency_smoothing
+
+buckets = BucketTable(app.config['RATE_LIMIT_SLOTS'])
+admission = Admission()
+
+def client_key(authorization, remote_addr):
+    if authorization and authorization.startswith('Bearer '):
+        data = token_signer.loads(authorization[len('Bearer '):])
+        if data is not None:
+            return 'user:%d' % data['id']
+    return 'address:%s' % remote_addr
+
+def request_cost(endpoint, method, args, authorization):
+    costs = app.config['RATE_LIMIT_COSTS']
+    if method == 'GET' and endpoint in listings and not any(arg in args for arg in paging_args):
+        cost = costs['full list']
+    else:
+        cost = costs.get(endpoint, costs['default'])
+    # Basic auth means a PBKDF2 password check, unless it's in the credential cache
+    if authorization and authorization.startswith('Basic '):
+        cost += costs['password']
+    return cost
+
+def long_poll(endpoint, args):
+    return endpoint in long_polls and args.get('wait') not in (None, '', '0')
+
+# Charge <cost> tokens to client <key>, returning 0 or the seconds to wait before retrying
+def take(key, cost):
+    return buckets.take(key, cost, app.config['RATE_LIMIT_RATE'], app.config['RATE_LIMIT_BURST'])
+
+def retry_after(seconds):
+    return str(max(1, int(math.ceil(seconds))))
+
+# (data, status, headers) of the response to a client that must wait <wait> seconds
+def too_many_requests(wait):
+    return { "message": "Too many requests, retry in %s seconds" % retry_after(wait) }, 429, \
+        {'Retry-After': retry_after(wait)}
+
+# (data, status, headers) of the response to a request turned away by admission control
+def server_busy():
+    return { "message": "Server is busy, try again later" }, 503, \
+        {'Retry-After': retry_after(app.config['ADMISSION_RETRY_AFTER'])}
+
+@app.before_request
+def limit_request():
+    if request.endpoint in exempt:
+        return None
+    if app.config['RATE_LIMIT_ENABLED']:
+        authorization = request.headers.get('Authorization')
+        wait = take(client_key(authorization, request.remote_addr),
+            request_cost(request.endpoint, request.method, request.args, authorization))
+        if wait:
+            return api.make_response(*too_many_requests(wait))
+    if app.config['ADMISSION_ENABLED'] and not long_poll(request.endpoint, request.args):
+        if not admission.enter(app.config['ADMISSION_MAX_IN_FLIGHT'], app.config['ADMISSION_MAX_LATENCY']):
+            return api.make_response(*server_busy())
+        g.admitted_at = time.perf_counter()
+    return None
+
+# Time to the first byte: runs before a streamed response's body is generated
+@app.after_request
+def time_request(response):
+    if 'admitted_at' in g:
+        g.latency = time.perf_counter() - g.admitted_at
+    return response
+
+# Runs once a streamed response has been fully sent, so streams count as in flight until then
+@app.teardown_request
+def release_request(exception=None):
+    if g.pop('admitted_at', None) is not None:
+        admission.leave(g.pop('latency', None))
@@ -0,0 +1,189 @@
+"""
+Per-request instrumentation
+Every request counts its SQL queries and the time spent in SQL, authentication and JSON
+serialization. The totals are sent back in a Server-Timing header and aggregated per endpoint
+for the Prometheus text exposition at /metrics. With PROFILE_ENABLED, a sample of requests
+is run under cProfile and those slower than PROFILE_THRESHOLD seconds are dumped to PROFILE_DIR.
+"""
+
+from . import basedir
+from .core import app, cache
+from flask import g, has_app_context, request, Response
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import cProfile
+import os
+import random
+import threading
+import time
+
+timers = ('sql', 'auth', 'serialize')
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def current():
+    if has_app_context():
+        return g.get('metrics')
+    return None
+
+# Add the time spent in the decorated function to the current request's <name> timer
+def timed(name):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            metrics = current()
+            if metrics is None:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                metrics[name] += time.perf_counter() - start
+        return wrapper
+    return decorator
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    metrics = current()
+    if metrics is not None:
+        metrics['queries'] += 1
+        metrics['sql'] += elapsed
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**values):
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in sorted(values.items()))
+
+class Registry(object):
+    """
+    Aggregated request metrics, keyed by endpoint
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.requests = {}
+        self.durations = {}
+        self.totals = {}
+
+    def observe(self, endpoint, method, status, duration, metrics):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.durations.setdefault(endpoint, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += duration
+            histogram[2] += 1
+
+            totals = self.totals.setdefault(endpoint, dict.fromkeys(('queries',) + timers, 0))
+            for name in totals:
+                totals[name] += metrics[name]
+
+    # Prometheus text exposition format, version 0.0.4
+    def render(self, cache_stats):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP books_wishlist_%s %s' % (name, help))
+            lines.append('# TYPE books_wishlist_%s %s' % (name, kind))
+            for suffix, sample_labels, value in samples:
+                lines.append('books_wishlist_%s%s%s %s' % (name, suffix, sample_labels, value))
+
+        with self.lock:
+            metric('requests_total', 'counter', 'Requests handled', [('', labels(endpoint=endpoint, method=method,
+                status=status), count) for (endpoint, method, status), count in sorted(self.requests.items())])
+
+            samples = []
+            for endpoint, (counts, total, count) in sorted(self.durations.items()):
+                for bound, bucket_count in zip(buckets, counts):
+                    samples.append(('_bucket', labels(endpoint=endpoint, le=bound), bucket_count))
+                samples.append(('_bucket', labels(endpoint=endpoint, le='+Inf'), count))
+                samples.append(('_sum', labels(endpoint=endpoint), repr(total)))
+                samples.append(('_count', labels(endpoint=endpoint), count))
+            metric('request_duration_seconds', 'histogram', 'Request duration', samples)
+
+            for name, help in (('queries', 'SQL queries executed'), ('sql', 'Time spent in SQL'),
+                    ('auth', 'Time spent verifying credentials'), ('serialize', 'Time spent encoding JSON')):
+                metric_name = 'sql_queries_total' if name == 'queries' else '%s_seconds_total' % name
+                metric(metric_name, 'counter', help, [('', labels(endpoint=endpoint), repr(totals[name]))
+                    for endpoint, totals in sorted(self.totals.items())])
+
+        for name in ('hits', 'misses', 'evictions'):
+            metric('cache_%s_total' % name, 'counter', 'Cache %s' % name,
+                [('', labels(backend=cache_stats['backend']), cache_stats[name])])
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Only one profiler can be active at a time, so concurrent slow requests aren't all profiled
+profile_lock = threading.Lock()
+
+@app.before_request
+def start_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return
+    g.metrics = dict.fromkeys(('queries',) + timers, 0)
+    g.metrics_start = time.perf_counter()
+
+    if app.config['PROFILE_ENABLED'] and random.random() < app.config['PROFILE_SAMPLE_RATE'] \
+            and profile_lock.acquire(False):
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:
+            g.profiler = None
+            profile_lock.release()
+
+@app.after_request
+def add_server_timing(response):
+    metrics = current()
+    if metrics is not None:
+        g.metrics_status = response.status_code
+        total = time.perf_counter() - g.metrics_start
+        response.headers.add('Server-Timing', 'db;dur=%.3f;desc="%d queries", auth;dur=%.3f, serialize;dur=%.3f, '
+            'total;dur=%.3f' % (metrics['sql'] * 1000, metrics['queries'], metrics['auth'] * 1000,
+            metrics['serialize'] * 1000, total * 1000))
+    return response
+
+# Runs once a streamed response has been fully sent, so its whole duration is recorded
+@app.teardown_request
+def record_metrics(exception=None):
+    metrics = current()
+    if metrics is None:
+        return
+    duration = time.perf_counter() - g.metrics_start
+    status = 500 if exception is not None else g.get('metrics_status', 500)
+    registry.observe(request.endpoint or 'unknown', request.method, status, duration, metrics)
+
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+        if duration >= app.config['PROFILE_THRESHOLD']:
+            dump_profile(profiler, duration)
+
+# Write a cProfile dump, e.g. 20181016-120000-123456-GET-book-512ms.prof
+# Open dumps with pstats or snakeviz, or turn them into a flame graph with flameprof
+def dump_profile(profiler, duration):
+    directory = os.path.join(basedir, app.config['PROFILE_DIR'])
+    os.makedirs(directory, exist_ok=True)
+    name = '%s-%06d-%s-%s-%dms.prof' % (time.strftime('%Y%m%d-%H%M%S'), random.randrange(10 ** 6), request.method,
+        (request.endpoint or 'unknown').replace(' ', '_'), duration * 1000)
+    profiler.dump_stats(os.path.join(directory, name))
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def prometheus_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return Response('Metrics are disabled\n', status=404, mimetype='text/plain')
+    return Response(registry.render(cache.stats()), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,82 @@
+"""
+Schema migrations for existing databases
+db.create_all() only creates missing tables, so changes to tables that already exist
+are applied here. SQLite's user_version pragma records how many have been applied.
+"""
+
+from .core import db
+from . import search
+
+# Add reverse index for /api/books/<isbn>/users lookups
+def add_user_books_isbn_index(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_user_books_isbn_user_id ON user_books (isbn, user_id)')
+
+# Add version counters for ETag / Last-Modified support
+def add_version_columns(connection):
+    connection.execute("ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT '1'")
+    connection.execute('ALTER TABLE books ADD COLUMN updated_at DATETIME')
+    connection.execute("ALTER TABLE users ADD COLUMN wishlist_version INTEGER NOT NULL DEFAULT '1'")
+    connection.execute('ALTER TABLE users ADD COLUMN wishlist_updated_at DATETIME')
+    connection.execute('UPDATE books SET updated_at = CURRENT_TIMESTAMP')
+    connection.execute('UPDATE users SET wishlist_updated_at = CURRENT_TIMESTAMP')
+
+# Add the FTS5 search index over book titles and authors
+def add_books_search_index(connection):
+    if search.has_fts5(connection):
+        search.create_index(connection)
+        search.rebuild_index(connection)
+
+# Add the materialized wishlist count behind /api/books/popular
+def add_wish_count(connection):
+    connection.execute("ALTER TABLE books ADD COLUMN wish_count INTEGER NOT NULL DEFAULT '0'")
+    connection.execute('UPDATE books SET wish_count = (SELECT count(*) FROM user_books WHERE user_books.isbn = books.isbn)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_books_wish_count_isbn ON books (wish_count DESC, isbn)')
+
+# Index books by last change, so the in-memory catalog can fetch recent writes
+def add_books_updated_at_index(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_books_updated_at ON books (updated_at)')
+
+# Add the change log behind /api/changes
+def add_changes_table(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+        'kind VARCHAR(8) NOT NULL, user_id INTEGER, isbn VARCHAR(16) NOT NULL, created_at DATETIME NOT NULL)')
+
+# Add the user directory used when users are sharded
+def add_user_directory(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS user_directory (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+        'email VARCHAR(120) NOT NULL, UNIQUE (email))')
+
+# Migrations in the order they were added; never reorder or remove entries
+MIGRATIONS = [
+    add_user_books_isbn_index,
+    add_version_columns,
+    add_books_search_index,
+    add_wish_count,
+    add_books_updated_at_index,
+    add_changes_table,
+    add_user_directory
+]
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+def stamp(connection, version=len(MIGRATIONS)):
+    connection.execute('PRAGMA user_version = %d' % version)
+
+# Freshly created databases already have the latest schema
+# create_all() also runs on existing databases, which are only stamped by upgrade(), so only
+# stamp when it has just created the users table, i.e. the database was empty
+@db.event.listens_for(db.metadata, 'after_create')
+def stamp_new_database(target, connection, tables=(), **kw):
+    if any(table.name == 'users' for table in tables):
+        stamp(connection)
+
+# Apply pending migrations to an existing database
+def upgrade(engine):
+    with engine.begin() as connection:
+        if not engine.dialect.has_table(connection, 'users'):
+            return
+        version = schema_version(connection)
+        for migration in MIGRATIONS[version:]:
+            migration(connection)
+        stamp(connection)
@@ -1,5 +1,7 @@
+from collections import Counter
 from datetime import datetime
-from . import db
+from .core import db
+from . import shards
 import json
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -7,16 +9,153 @@ from werkzeug.security import generate_password_hash, check_password_hash
 user_books = db.Table('user_books',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
     db.Column('isbn', db.String, db.ForeignKey('books.isbn')), 
-    db.PrimaryKeyConstraint('user_id', 'isbn')
+    db.PrimaryKeyConstraint('user_id', 'isbn'),
+    # Reverse index for looking up the users who have a book on their wishlist
+    db.Index('ix_user_books_isbn_user_id', 'isbn', 'user_id')
+)
+
+# Append-only log of catalog and wishlist changes behind /api/changes
+# kind is 'book' (book <isbn> was added or updated), 'add' or 'remove' (book <isbn> was
+# added to or removed from user <user_id>'s wishlist). AUTOINCREMENT keeps seq from being
+# reused once old entries are pruned.
+changes = db.Table('changes',
+    db.Column('seq', db.Integer, primary_key=True),
+    db.Column('kind', db.String(8), nullable=False),
+    db.Column('user_id', db.Integer),
+    db.Column('isbn', db.String(16), nullable=False),
+    db.Column('created_at', db.DateTime, nullable=False, default=datetime.utcnow),
+    sqlite_autoincrement=True
+)
+
+# Emails of every user and the ids allocated to them, in the main database
+# Only used with SHARD_COUNT > 1, where it keeps ids and emails unique across the shards
+user_directory = db.Table('user_directory',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('email', db.String(120), nullable=False, unique=True),
+    sqlite_autoincrement=True
 )
 
 def commit():
     db.session.commit()
 
+# Wishlist membership is checked and changed with keyed lookups on user_books,
+# so the full UserModel.books collection is only loaded when it is returned
+def in_wishlist(user_id, isbn):
+    return db.session.query(db.exists().where(db.and_(
+        user_books.c.user_id == user_id, user_books.c.isbn == isbn))).scalar()
+
+# Link book <isbn> to user <user_id>'s wishlist, returning False if it was already there
+# INSERT OR IGNORE makes this a single statement that can't fail on the primary key,
+# however many requests add the same book at once
+def add_to_wishlist(user_id, isbn):
+    db.session.flush()
+    added = db.session.execute(user_books.insert().prefix_with('OR IGNORE').values(
+        user_id=user_id, isbn=isbn)).rowcount > 0
+    if added:
+        change_wish_count(isbn, 1)
+    return added
+
+# Add book <isbn> unless a book with that ISBN exists, returning whether it was added
+@shards.shared
+def insert_book(isbn, title, author, pub_date):
+    return db.session.execute(BookModel.__table__.insert().prefix_with('OR IGNORE').values(isbn=isbn, title=title,
+        author=author, pub_date=pub_date)).rowcount > 0
+
+# Add book <isbn>, or replace its details and bump its version if it exists, in one statement
+@shards.shared
+def upsert_book(isbn, title, author, pub_date):
+    statement = db.text('INSERT INTO books (isbn, title, author, pub_date, version, updated_at, wish_count) '
+        'VALUES (:isbn, :title, :author, :pub_date, 1, :updated_at, 0) '
+        'ON CONFLICT (isbn) DO UPDATE SET title = excluded.title, author = excluded.author, '
+        'pub_date = excluded.pub_date, version = version + 1, updated_at = excluded.updated_at').bindparams(
+        db.bindparam('pub_date', type_=BookModel.pub_date.type), db.bindparam('updated_at', type_=BookModel.updated_at.type))
+    db.session.execute(statement, {'isbn': isbn, 'title': title, 'author': author, 'pub_date': pub_date,
+        'updated_at': datetime.utcnow()})
+
+# Record a change in the same transaction as the write it describes
+@shards.shared
+def record_change(kind, isbn, user_id=None):
+    db.session.execute(changes.insert().values(kind=kind, isbn=isbn, user_id=user_id))
+
+# Reserve a user id for <email> in the directory, returning None if the email is taken
+def allocate_user_id(email):
+    with shards.using(None):
+        result = db.session.execute(user_directory.insert().prefix_with('OR IGNORE').values(email=email))
+    return result.lastrowid if result.rowcount > 0 else None
+
+# Shard holding the user with <email>, or None if there's no such user
+def shard_for_email(email):
+    if not shards.sharded():
+        return 0
+    with shards.using(None):
+        user_id = db.session.execute(db.select([user_directory.c.id]).where(user_directory.c.email == email)).scalar()
+    return shards.shard_for(user_id) if user_id is not None else None
+
+def wishlist_user_ids(isbn):
+    query = db.select([user_books.c.user_id]).where(user_books.c.isbn == isbn)
+    return [user_id for ids in shards.each(lambda: db.session.execute(query).fetchall()) for user_id, in ids]
+
+def remove_from_wishlist(user_id, isbn):
+    removed = db.session.execute(user_books.delete().where(db.and_(
+        user_books.c.user_id == user_id, user_books.c.isbn == isbn))).rowcount > 0
+    if removed:
+        change_wish_count(isbn, -1)
+    return removed
+
+# books.wish_count is the number of wishlists containing each book
+# It is changed in the same transaction as user_books, and recounted by reconcile_wish_counts()
+@shards.shared
+def change_wish_count(isbn, delta):
+    db.session.execute(BookModel.__table__.update().where(BookModel.isbn == isbn).values(
+        wish_count=BookModel.wish_count + delta))
+
+# Recount wish_count from user_books for books <isbns> (default all), returning how many were wrong
+def reconcile_wish_counts(isbns=None):
+    if shards.sharded():
+        return reconcile_sharded_wish_counts(isbns)
+    count = db.select([db.func.count()]).where(user_books.c.isbn == BookModel.isbn).as_scalar()
+    update = BookModel.__table__.update().where(BookModel.wish_count != count)
+    if isbns is not None:
+        update = update.where(BookModel.isbn.in_(isbns))
+    return db.session.execute(update.values(wish_count=count)).rowcount
+
+# Same, adding up the wishlists on every shard
+def reconcile_sharded_wish_counts(isbns=None):
+    query = db.select([user_books.c.isbn, db.func.count()]).group_by(user_books.c.isbn)
+    books = db.select([BookModel.isbn, BookModel.wish_count])
+    if isbns is not None:
+        query = query.where(user_books.c.isbn.in_(isbns))
+        books = books.where(BookModel.isbn.in_(isbns))
+    counts = Counter()
+    for rows in shards.each(lambda: db.session.execute(query).fetchall()):
+        counts.update(dict(rows))
+    with shards.using(None):
+        wrong = [{'book_isbn': isbn, 'count': counts[isbn]} for isbn, wish_count in db.session.execute(books)
+            if wish_count != counts[isbn]]
+        if wrong:
+            db.session.execute(BookModel.__table__.update().where(BookModel.isbn == db.bindparam('book_isbn'))
+                .values(wish_count=db.bindparam('count')), wrong)
+    return len(wrong)
+
+# Version counters behind the ETag and Last-Modified headers of wishlist reads (upsert_book bumps books')
+# Bump them in the same transaction as the change they describe
+def touch_wishlists(user_ids):
+    if user_ids:
+        touch_wishlists_where(UserModel.id.in_(user_ids))
+
+# Bump every wishlist that contains book <isbn>, on every shard
+def touch_wishlists_with_book(isbn):
+    shards.each(lambda: touch_wishlists_where(UserModel.id.in_(
+        db.select([user_books.c.user_id]).where(user_books.c.isbn == isbn))))
+
+def touch_wishlists_where(condition):
+    db.session.execute(UserModel.__table__.update().where(condition).values(
+        wishlist_version=UserModel.wishlist_version + 1, wishlist_updated_at=datetime.utcnow()))
+
 class UserModel(db.Model):
     """
     Users resource database model
-    Attributes: id, first_name, last_name, email, password_hash
+    Attributes: id, first_name, last_name, email, password_hash, wishlist_version, wishlist_updated_at
     """
 
     __tablename__ = 'users'
@@ -27,9 +166,12 @@ class UserModel(db.Model):
     last_name = db.Column(db.String(64))
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
+    wishlist_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    wishlist_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Add relationship to books
-    books = db.relationship('BookModel', secondary='user_books', backref='users', lazy='subquery')
+    # Neither side is loaded until accessed; list endpoints select columns directly (see serializers.py)
+    books = db.relationship('BookModel', secondary='user_books', backref='users', lazy='select')
 
     # Password security
     def set_password(self, password):
@@ -60,7 +202,7 @@ class UserModel(db.Model):
 class BookModel(db.Model):
     """
     Books resource database model
-    Attributes: isbn, title, author, pub_date
+    Attributes: isbn, title, author, pub_date, version, updated_at, wish_count
     """
 
     __tablename__ = 'books'
@@ -70,6 +212,9 @@ class BookModel(db.Model):
     title = db.Column(db.String(140))
     author = db.Column(db.String(128), index=True)
     pub_date = db.Column(db.Date)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    wish_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Add new book from database
     def add_to_db(self):
@@ -89,4 +234,7 @@ class BookModel(db.Model):
             'title': self.title,
             'author': self.author,
             'pub_date': datetime.strftime(self.pub_date, '%Y-%m-%d')
-        } )
\ No newline at end of file
+        } )
+
+# Most wished-for books first, for /api/books/popular
+db.Index('ix_books_wish_count_isbn', BookModel.wish_count.desc(), BookModel.isbn)
\ No newline at end of file
@@ -0,0 +1,88 @@
+"""
+Request body schemas, built once at import time
+A schema reads every field of a JSON or form body in one pass, converting values to strings
+like reqparse's type=str and normalizing ISBNs and publication dates. Errors are reported in
+the same format as RequestParser: a missing field gives {"message": {<field>: <help>}} with a 400.
+"""
+
+from datetime import date
+from flask import request
+from flask_restful import abort
+import re
+
+date_format_error = "Publication date (pub_date) must be in YYYY-mm-dd format"
+# int() alone would also take signs, spaces, underscores and other digits
+date_pattern = re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})')
+
+# Parse YYYY-mm-dd (month and day may be one digit, as with strptime), or return None
+def parse_date(value):
+    match = date_pattern.fullmatch(value) if isinstance(value, str) else None
+    try:
+        return date(*map(int, match.groups())) if match else None
+    except ValueError:
+        return None
+
+isbn_format_error = "ISBN must be digits, optionally ending in X"
+isbn_separators = re.compile(r'[\s-]+')
+isbn_pattern = re.compile(r'[0-9]+X?')
+
+# '0-306-40615-x' -> '030640615X', or None if that isn't digits with an optional trailing X
+def normalize_isbn(value):
+    value = isbn_separators.sub('', value).upper()
+    return value if isbn_pattern.fullmatch(value) else None
+
+class Field(object):
+    """
+    Required body field <name>, reported as <help> when missing
+    <convert> turns the string value into the parsed value, returning None if it's
+    invalid, in which case <error> is returned as the message.
+    """
+
+    def __init__(self, name, help, convert=None, error=None):
+        self.name = name
+        self.help = help
+        self.convert = convert
+        self.error = error
+
+class Schema(object):
+    """
+    Ordered set of fields read from the JSON body, falling back to form and query values
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def parse(self):
+        body = request.get_json(silent=True) if request.is_json else None
+        if not isinstance(body, dict):
+            body = {}
+        values = request.values
+
+        data = {}
+        for field in self.fields:
+            value = body.get(field.name)
+            if value is None:
+                value = values.get(field.name)
+            if value is None:
+                abort(400, message={field.name: field.help})
+            if not isinstance(value, str):
+                value = str(value)
+            if field.convert is not None:
+                value = field.convert(value)
+                if value is None:
+                    abort(400, message=field.error)
+            data[field.name] = value
+        return data
+
+title = Field('title', "Title not provided")
+author = Field('author', "Author not provided")
+isbn = Field('isbn', "ISBN not provided", normalize_isbn, isbn_format_error)
+pub_date = Field('pub_date', "Publication date not provided", parse_date, date_format_error)
+
+new_user = Schema(
+    Field('first_name', 'First name not provided'),
+    Field('last_name', 'Last name not provided'),
+    Field('email', 'Email address not provided'),
+    Field('password', 'Password not provided'))
+new_book = Schema(title, author, isbn, pub_date)
+book_update = Schema(title, author, pub_date)
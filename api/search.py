@@ -0,0 +1,94 @@
+"""
+Book search backed by an SQLite FTS5 index over title and author
+books_fts is an external-content FTS5 table keyed by books.rowid and kept in sync by
+triggers, so every write path (including bulk import) updates it in the same transaction.
+Run `flask rebuild-search-index` after a VACUUM, which may renumber books.rowid.
+"""
+
+from .core import db
+from .models import BookModel
+from .serializers import books
+import re
+
+fts_statements = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(title, author, content='books', content_rowid='rowid')",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author) VALUES (new.rowid, new.title, new.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.rowid, old.title, old.author);
+        INSERT INTO books_fts(rowid, title, author) VALUES (new.rowid, new.title, new.author);
+    END"""
+]
+
+fts = db.table('books_fts', db.column('rowid'), db.column('rank'))
+books_rowid = db.literal_column('books.rowid')
+
+# Whether the linked SQLite library was built with FTS5, checked once per process
+fts5_available = None
+
+def has_fts5(connection):
+    global fts5_available
+    if fts5_available is None:
+        options = [option for option, in connection.execute('PRAGMA compile_options')]
+        fts5_available = 'ENABLE_FTS5' in options
+    return fts5_available
+
+def create_index(connection):
+    for statement in fts_statements:
+        connection.execute(statement)
+
+def rebuild_index(connection):
+    connection.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
+# Create books_fts alongside the books table, when SQLite was built with FTS5
+@db.event.listens_for(BookModel.__table__, 'after_create')
+def create_index_with_table(target, connection, **kw):
+    if has_fts5(connection):
+        create_index(connection)
+
+@db.event.listens_for(BookModel.__table__, 'before_drop')
+def drop_index_with_table(target, connection, **kw):
+    connection.execute('DROP TABLE IF EXISTS books_fts')
+
+# Turn free text into an FTS5 query that matches every word as a prefix, e.g. 'lord ring' -> '"lord"* "ring"*'
+def match_query(text):
+    words = re.findall(r'\w+', text, re.UNICODE)
+    return ' '.join('"%s"*' % word for word in words)
+
+def search_books(q=None, author=None, published_after=None, published_before=None, limit=100, after=None):
+    """
+    Return (books, next cursor) matching every given filter
+    Full-text matches are ranked by bm25 and paged by offset; filter-only searches are
+    ordered and paged by ISBN like the plain listing. <after> is the previous next cursor.
+    """
+    query = books.query()
+    if author is not None:
+        query = query.filter(BookModel.author == author)
+    if published_after is not None:
+        query = query.filter(BookModel.pub_date >= published_after)
+    if published_before is not None:
+        query = query.filter(BookModel.pub_date <= published_before)
+
+    if q is None:
+        if after is not None:
+            query = query.filter(BookModel.isbn > after)
+        rows = query.order_by(BookModel.isbn).limit(limit + 1).all()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return books.dicts(rows[:limit]), next_cursor
+
+    offset = int(after or 0)
+    if has_fts5(db.session.connection()):
+        query = query.join(fts, fts.c.rowid == books_rowid).filter(db.literal_column('books_fts').match(match_query(q)))
+        query = query.order_by(fts.c.rank)
+    else:
+        for word in re.findall(r'\w+', q, re.UNICODE):
+            pattern = '%' + word + '%'
+            query = query.filter(db.or_(BookModel.title.like(pattern), BookModel.author.like(pattern)))
+        query = query.order_by(BookModel.isbn)
+    rows = query.offset(offset).limit(limit + 1).all()
+    next_cursor = str(offset + limit) if len(rows) > limit else None
+    return books.dicts(rows[:limit]), next_cursor
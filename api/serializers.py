@@ -0,0 +1,100 @@
+"""
+Fast serialization for list and lookup responses
+Rows are selected as plain column tuples, skipping ORM instances and the identity map, and
+turned into the same dicts as UserModel.serialize and BookModel.serialize. Responses are
+encoded with the standard library by default (JSON_BACKEND = 'json'); JSON_BACKEND = 'orjson'
+uses orjson instead, which is faster but writes compact separators and unescaped non-ASCII,
+and 'auto' uses orjson when it is installed.
+"""
+
+from datetime import datetime
+from flask import current_app, make_response
+from flask_restful.representations.json import output_json as restful_output_json
+from .core import db
+from . import shards
+from .metrics import timed
+from .models import UserModel, BookModel, user_books
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Same output as datetime.strftime(value, '%Y-%m-%d'), which doesn't zero-pad years before 1000
+def format_date(value):
+    if value is None:
+        return None
+    if value.year < 1000:
+        return datetime.strftime(value, '%Y-%m-%d')
+    return value.isoformat()
+
+def book_dict(row):
+    return {
+        'isbn': row[0],
+        'title': row[1],
+        'author': row[2],
+        'pub_date': format_date(row[3])
+    }
+
+def user_dict(row):
+    return {
+        'user_id': row[0],
+        'first_name': row[1],
+        'last_name': row[2],
+        'email': row[3]
+    }
+
+class RowSerializer(object):
+    """
+    Selects <columns> as tuples and converts each row with <to_dict>
+    The first column is the primary key used for ordering and pagination.
+    """
+
+    def __init__(self, columns, to_dict):
+        self.columns = columns
+        self.key = columns[0]
+        self.to_dict = to_dict
+
+    def query(self):
+        return db.session.query(*self.columns)
+
+    def dicts(self, rows):
+        return list(map(self.to_dict, rows))
+
+books = RowSerializer((BookModel.isbn, BookModel.title, BookModel.author, BookModel.pub_date), book_dict)
+users = RowSerializer((UserModel.id, UserModel.first_name, UserModel.last_name, UserModel.email), user_dict)
+
+def wishlist_books(user_id):
+    query = books.query().join(user_books, user_books.c.isbn == BookModel.isbn).filter(user_books.c.user_id == user_id)
+    return books.dicts(query)
+
+# Users with book <isbn> on their wishlist, gathered from every shard in parallel
+def book_users(isbn):
+    def fetch():
+        return users.query().join(user_books, user_books.c.user_id == UserModel.id).filter(user_books.c.isbn == isbn).all()
+    if not shards.sharded():
+        return users.dicts(fetch())
+    return users.dicts(sorted((row for rows in shards.gather(fetch) for row in rows), key=lambda row: row[0]))
+
+def use_orjson():
+    backend = current_app.config['JSON_BACKEND']
+    if backend == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_BACKEND is 'orjson' but orjson is not installed")
+    return orjson is not None and backend in ('auto', 'orjson') and not current_app.debug
+
+@timed('serialize')
+def dumps(data):
+    if use_orjson():
+        return orjson.dumps(data).decode('UTF-8')
+    return json.dumps(data)
+
+# Representation for application/json responses
+# Falls back to flask-restful's own encoder when orjson is unavailable, disabled or in debug mode
+@timed('serialize')
+def output_json(data, code, headers=None):
+    if not use_orjson():
+        return restful_output_json(data, code, headers)
+    response = make_response(orjson.dumps(data) + b'\n', code)
+    response.headers.extend(headers or {})
+    return response
@@ -0,0 +1,92 @@
+"""
+Production server: gunicorn with preloaded, prefork workers
+The master process creates the schema and warms the cache once, then forks SERVER_WORKERS
+workers that share that state copy-on-write. `kill -HUP <master pid>` replaces the workers
+gracefully: old workers finish their in-flight requests (up to SERVER_GRACEFUL_TIMEOUT seconds)
+while new ones start accepting connections.
+With the in-process cache (CACHE_BACKEND = 'lru') a write only invalidates the cache of the
+worker that handled it, so with more than one worker it is bypassed; set CACHE_BACKEND = 'redis'
+to keep caching.
+"""
+
+from .core import app, db, cache
+from . import serializers, startup
+from .models import BookModel
+from .views import load_book
+import multiprocessing
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
+# Cache the <limit> most wished-for books and their wishlist users
+def warm_cache(limit):
+    popular = db.session.query(BookModel.isbn).filter(BookModel.wish_count > 0) \
+        .order_by(BookModel.wish_count.desc(), BookModel.isbn).limit(limit)
+    warmed = 0
+    for isbn, in popular:
+        cache.set('book:' + isbn, load_book(isbn))
+        cache.set('book_users:' + isbn, serializers.book_users(isbn))
+        warmed += 1
+    return warmed
+
+# Run once in the master before workers are forked
+def prepare(flask_app):
+    # Workers share the schema checks and the memory-mapped catalog snapshot
+    startup()
+    with flask_app.app_context():
+        warm_cache(flask_app.config['CACHE_WARM_SIZE'])
+    # Workers must not inherit the master's open SQLite connections
+    db.dispose_engines(flask_app)
+
+# Workers must share the cache, or not cache at all, to see each other's writes
+def shared_cache(config):
+    return config['CACHE_BACKEND'] != 'lru'
+
+# Stop caching in process if <workers> would each have their own cache, which serves stale
+# data after writes handled by the others. Returns whether it did.
+def bypass_local_cache(config, workers):
+    if workers > 1 and not shared_cache(config):
+        cache.clear()
+        cache.max_size = 0
+        return True
+    return False
+
+# SERVER_WORKERS = 0 means one worker per CPU core
+def server_options(config):
+    return {
+        'bind': config['SERVER_BIND'],
+        'workers': config['SERVER_WORKERS'] or multiprocessing.cpu_count(),
+        'worker_class': config['SERVER_WORKER_CLASS'],
+        'threads': config['SERVER_THREADS'],
+        'timeout': config['SERVER_TIMEOUT'],
+        'graceful_timeout': config['SERVER_GRACEFUL_TIMEOUT'],
+        'preload_app': True
+    }
+
+class Server(BaseApplication):
+    """
+    gunicorn application serving the Flask app with <options> from server_options()
+    """
+
+    def __init__(self, flask_app, options):
+        self.flask_app = flask_app
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    # With preload_app, gunicorn calls this once in the master
+    def load(self):
+        prepare(self.flask_app)
+        return self.flask_app
+
+def run(**options):
+    if BaseApplication is object:
+        raise RuntimeError('The production server requires gunicorn (pip install gunicorn)')
+    options = dict(server_options(app.config), **options)
+    bypass_local_cache(app.config, options['workers'])
+    Server(app, options).run()
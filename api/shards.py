@@ -0,0 +1,168 @@
+"""
+Users and wishlists partitioned across SQLite databases, enabled with SHARD_COUNT > 1
+The users and user_books rows of user <id> are stored in shard id % SHARD_COUNT, a
+DATABASE.shard<n>.db file next to DATABASE, each with its own writer lock, WAL and connection
+pools. The shared tables (books, the change log, the search index and the user directory,
+which allocates user ids and maps emails to them) stay in DATABASE, which every shard
+connection attaches, so a query routed to a shard can still join books. Requests are routed
+by the <id> in their URL; queries over every user run on all shards.
+With SHARD_COUNT = 1 everything stays in DATABASE and none of this routing applies.
+"""
+
+from . import basedir
+from .core import app, db
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import _request_ctx_stack, g, has_app_context, has_request_context, request
+from functools import wraps
+from itertools import islice
+from operator import itemgetter
+import heapq
+import os
+import threading
+
+def count():
+    return app.config['SHARD_COUNT']
+
+def sharded():
+    return count() > 1
+
+def shard_for(user_id):
+    return user_id % count()
+
+# Bind key of <shard>, or None (the main database) for None or when there's only one shard
+def bind_key(shard):
+    return 'shard%d' % shard if shard is not None and sharded() else None
+
+def database_path(shard):
+    base, ext = os.path.splitext(os.path.join(basedir, app.config['DATABASE']))
+    return '%s.shard%d%s' % (base, shard, ext)
+
+# Register a bind for every shard
+# Call again after changing SHARD_COUNT
+def configure():
+    app.config['SQLALCHEMY_BINDS'] = {bind_key(shard): 'sqlite:///' + database_path(shard)
+        for shard in range(count())} if sharded() else {}
+
+# Create the users and user_books tables in every shard that doesn't have them
+# Users can't be moved between databases, so sharding must be enabled before any are added
+def create_tables():
+    if not sharded():
+        return
+    if db.engine.execute('SELECT 1 FROM users LIMIT 1').scalar():
+        raise RuntimeError('%s has users, so SHARD_COUNT can no longer be changed' % app.config['DATABASE'])
+    tables = [db.metadata.tables['users'], db.metadata.tables['user_books']]
+    for shard in range(count()):
+        db.metadata.create_all(db.get_engine(app, bind_key(shard)), tables=tables)
+
+# Shard the current request or task is routed to, or None for the main database
+def current():
+    return g.get('shard') if has_app_context() else None
+
+# Route the session to <shard> (None for the main database) for the duration of the block
+@contextmanager
+def using(shard):
+    previous = g.get('shard'), g.get('shard_bind')
+    g.shard, g.shard_bind = shard, bind_key(shard)
+    try:
+        yield
+    finally:
+        g.shard, g.shard_bind = previous
+
+def call(shard, function, *args):
+    with using(shard):
+        return function(*args)
+
+# Run the decorated function on the main database, whichever shard the request is routed to
+# Used for writes to the shared tables, so shard connections only ever write to their shard
+def shared(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with using(None):
+            return f(*args, **kwargs)
+    return wrapper
+
+# Take the main database's write lock before any shard's, so transactions that write to
+# both always lock them in the same order and can't deadlock each other
+def lock_main():
+    if sharded():
+        with using(None):
+            db.session.execute('BEGIN IMMEDIATE')
+
+# Group <user_ids> by shard: {shard: [user_id, ...]}
+def group(user_ids):
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for(user_id), []).append(user_id)
+    return groups
+
+# Return [<function>() on each shard], one shard after another in this session
+def each(function):
+    return [call(shard, function) for shard in range(count())]
+
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+
+# Thread pool for gather(), started on first use in each process
+def pool():
+    global executor, executor_pid
+    with executor_lock:
+        if executor_pid != os.getpid():
+            executor = ThreadPoolExecutor(count(), thread_name_prefix='shard')
+            executor_pid = os.getpid()
+    return executor
+
+# Run <function> on <shard> in a pool thread, which has its own session, removed when <context> ends
+def run(shard, function, context):
+    with context:
+        return call(shard, function)
+
+# Return [<function>() on each shard], running them in parallel
+# Each runs in a copy of the current request context (or a new app context outside
+# requests), so GET requests still read from the read-only pools
+def gather(function):
+    if not sharded():
+        return [function()]
+    futures = []
+    for shard in range(count()):
+        context = _request_ctx_stack.top.copy() if has_request_context() else app.app_context()
+        futures.append(pool().submit(run, shard, function, context))
+    return [future.result() for future in futures]
+
+class Merged(object):
+    """
+    Rows of <serializer> (see serializers.py) from every shard, merged in primary key order
+    Used as the <source> of paginate(), stream() and batch_get().
+    """
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+    # Return up to <limit> rows (all if None), starting after key <after>
+    def page(self, limit=None, after=None):
+        def fetch():
+            query = self.serializer.query()
+            if after is not None:
+                query = query.filter(self.serializer.key > after)
+            query = query.order_by(self.serializer.key)
+            return (query.limit(limit) if limit is not None else query).all()
+        return list(islice(heapq.merge(*gather(fetch), key=itemgetter(0)), limit))
+
+    # Return the row for user <key>, or None
+    def get(self, key):
+        with using(shard_for(key)):
+            return self.serializer.query().filter(self.serializer.key == key).first()
+
+# The user rows of <serializer> from every shard, or None when there's only one
+def merged(serializer):
+    return Merged(serializer) if sharded() else None
+
+# Route requests for /users/<id>/... to user <id>'s shard
+@app.before_request
+def route_request():
+    if sharded() and request.view_args and 'id' in request.view_args:
+        shard = shard_for(request.view_args['id'])
+        g.shard, g.shard_bind = shard, bind_key(shard)
+
+configure()
@@ -1,18 +1,273 @@
 from datetime import datetime
-from . import app, api, auth
-from .models import UserModel, BookModel, commit
-from flask import g
-from flask_restful import Resource, reqparse
+from .core import app, api, auth, basic_auth, token_auth, cache
+from .bulk import read_rows, import_books, chunks, max_params
+from .credentials import CredentialCache, TokenSigner
+from .metrics import timed
+from . import catalog, compression, feed, schemas, serializers, shards
+from .search import search_books, match_query
+from .serializers import dumps, output_json
+from .idempotency import idempotent
+from .writer import write
+from .models import UserModel, BookModel, commit, in_wishlist, add_to_wishlist, remove_from_wishlist, \
+    wishlist_user_ids, insert_book, upsert_book, record_change, touch_wishlists, touch_wishlists_with_book, \
+    allocate_user_id, shard_for_email
+from flask import g, request, Response, stream_with_context
+from flask_restful import Resource, abort
+import io
+import math
+
+credential_cache = CredentialCache(app.config['SECRET_KEY'],
+    max_size = app.config['CREDENTIAL_CACHE_SIZE'], ttl = app.config['CREDENTIAL_CACHE_TTL'])
+token_signer = TokenSigner(app.config['SECRET_KEY'], ttl = app.config['TOKEN_TTL'])
 
 # Use for HTTP basic auth
-@auth.verify_password
+# Recently verified credentials are cached so the password is only hashed once per TTL
+# The user is looked up on the shard the directory has for their email
+@basic_auth.verify_password
+@timed('auth')
 def verify_password(email, password):
-    user = UserModel.query.filter_by(email = email).first()
-    if not user or not user.check_password(password):
+    shard = shard_for_email(email)
+    if shard is None:
         return False
+    with shards.using(shard):
+        user = UserModel.query.filter_by(email = email).first()
+    if not user:
+        return False
+    if credential_cache.get(email, password, user.password_hash) != user.id:
+        if not user.check_password(password):
+            return False
+        credential_cache.add(email, password, user.id, user.password_hash)
     g.user = user
+    g.user_id = user.id
+    return True
+
+# Use for bearer tokens issued by /api/token
+@token_auth.verify_token
+@timed('auth')
+def verify_token(token):
+    data = token_signer.loads(token)
+    if data is None:
+        return False
+    g.user_id = data['id']
     return True
 
+# Parse ?limit= and ?after= for keyset pagination
+# Returns (limit, after), or (None, None) if the full list was requested
+def page_args(key_type):
+    if 'limit' not in request.args and 'after' not in request.args:
+        return None, None
+
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+    except ValueError:
+        abort(400, message="Page size (limit) must be an integer")
+    if limit < 1:
+        abort(400, message="Page size (limit) must be a positive integer")
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = key_type(after)
+        except ValueError:
+            abort(400, message="Invalid cursor (after)")
+    return limit, after
+
+# Fetch up to <limit> rows as tuples ordered by primary key, starting after <after>
+def fetch_page(serializer, limit, after=None):
+    query = serializer.query()
+    if after is not None:
+        query = query.filter(serializer.key > after)
+    return query.order_by(serializer.key).limit(limit).all()
+
+# Return one page of rows, along with the cursor for the next page
+# Rows are read from <source> (the book catalog, or users merged from every shard) instead of the database if it's given
+def paginate(name, serializer, key_type, source=None):
+    limit, after = page_args(key_type)
+    if limit is None:
+        return {name: serializer.dicts(source.page() if source is not None else serializer.query())}
+
+    if source is not None:
+        rows = source.page(limit + 1, after)
+    else:
+        rows = fetch_page(serializer, limit + 1, after)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    return {name: serializer.dicts(rows), 'next': next_cursor}
+
+# Stream every row in primary key order, reading <STREAM_BATCH_SIZE> rows at a time
+# ?stream=ndjson writes one JSON object per line, ?stream=json writes the usual {name: [...]} document
+# Rows are read from <source> instead of the database if it's given
+def stream(name, serializer, source=None):
+    fmt = request.args.get('stream')
+    if fmt not in ('ndjson', 'json'):
+        abort(400, message="Stream format (stream) must be ndjson or json")
+    batch_size = app.config['STREAM_BATCH_SIZE']
+
+    def rows():
+        after = None
+        while True:
+            batch = source.page(batch_size, after) if source is not None else fetch_page(serializer, batch_size, after)
+            for row in batch:
+                yield dumps(serializer.to_dict(row))
+            if len(batch) < batch_size:
+                return
+            after = batch[-1][0]
+
+    def ndjson():
+        for row in rows():
+            yield row + '\n'
+
+    def json_array():
+        yield '{"%s": [' % name
+        separator = ''
+        for row in rows():
+            yield separator + row
+            separator = ', '
+        yield ']}\n'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(json_array()), mimetype='application/json')
+
+# Return the rows for the comma-separated keys in ?<arg>=, in the requested order
+# Keys that don't exist are listed under 'missing' instead of failing the request
+def batch_get(name, serializer, arg, parse_key, source=None):
+    keys = []
+    for value in request.args[arg].split(','):
+        value = value.strip()
+        if value:
+            try:
+                key = parse_key(value)
+            except ValueError:
+                key = None
+            if key is None:
+                abort(400, message="Invalid %s: %s" % (arg, value))
+            keys.append(key)
+    keys = list(dict.fromkeys(keys))
+    if len(keys) > app.config['BATCH_MAX_KEYS']:
+        abort(400, message="At most %d values of %s can be requested at once" % (app.config['BATCH_MAX_KEYS'], arg))
+
+    if source is not None:
+        rows = {key: row for key, row in zip(keys, map(source.get, keys)) if row is not None}
+    else:
+        rows = {}
+        for chunk in chunks(keys, max_params):
+            for row in serializer.query().filter(serializer.key.in_(chunk)):
+                rows[row[0]] = row
+    return {
+        name: [serializer.to_dict(rows[key]) for key in keys if key in rows],
+        'missing': [key for key in keys if key not in rows]
+    }
+
+search_args = ('q', 'author', 'published_after', 'published_before')
+
+# Parse a YYYY-mm-dd date filter from the query string
+def date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    value = schemas.parse_date(value)
+    if value is None:
+        abort(400, message="Publication date filter (%s) must be in YYYY-mm-dd format" % name)
+    return value
+
+# Search books by ?q= (title/author words), ?author= (exact) and publication date range
+# Results are always paginated; the next cursor is opaque and passed back as ?after=
+def search():
+    q = request.args.get('q')
+    if q is not None and not match_query(q):
+        abort(400, message="Search query (q) must contain at least one word")
+    limit, after = page_args(str)
+    if limit is None:
+        limit = app.config['PAGE_SIZE']
+    if q is not None and after is not None and not after.isdigit():
+        abort(400, message="Invalid cursor (after)")
+
+    results, next_cursor = search_books(q = q, author = request.args.get('author'),
+        published_after = date_arg('published_after'), published_before = date_arg('published_before'),
+        limit = limit, after = after)
+    return { 'books': results, 'next': next_cursor }
+
+# Return the cached value for <key>, calling <load> to fill the cache on a miss
+# Keys: book:<isbn>, user:<id>, wishlist:<user id>, book_users:<isbn>
+def cached(key, load):
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        cache.set(key, value)
+    return value
+
+epoch = datetime(1970, 1, 1)
+
+# Seconds since the epoch for a naive UTC datetime, so it can be cached as JSON
+def timestamp(value):
+    return value and (value - epoch).total_seconds()
+
+# Cache entries for books and wishlists are [body, version, last modified]
+def load_book(isbn):
+    books = catalog.current()
+    if books is not None:
+        row = books.get(isbn)
+        if row is None:
+            abort(404)
+        return [serializers.book_dict(row), row[4], row[5] or None]
+
+    row = serializers.books.query().add_columns(BookModel.version, BookModel.updated_at).filter(BookModel.isbn == isbn).first()
+    if row is None:
+        abort(404)
+    return [serializers.book_dict(row), row.version, timestamp(row.updated_at)]
+
+def book_version(isbn):
+    books = catalog.current()
+    if books is not None:
+        row = books.get(isbn)
+        return row and row[4]
+    return BookModel.query.with_entities(BookModel.version).filter_by(isbn=isbn).scalar()
+
+def load_wishlist(id):
+    user = UserModel.query.with_entities(UserModel.wishlist_version, UserModel.wishlist_updated_at).filter_by(id=id).first()
+    if user is None:
+        abort(404)
+    return [serializers.wishlist_books(id), user.wishlist_version, timestamp(user.wishlist_updated_at)]
+
+def versioned_response(data, etag, modified):
+    response = api.make_response(data, 200)
+    response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = datetime.utcfromtimestamp(modified)
+    return response.make_conditional(request)
+
+# Answer a GET for a resource cached under <key>, with a strong ETag of <etag_prefix>-<version>
+# On a cache miss, If-None-Match is checked against <load_version>() first, so a 304 needs
+# neither the full row fetch nor serialization
+def conditional_get(name, key, etag_prefix, load, load_version):
+    entry = cache.get(key)
+    if entry is None:
+        if request.if_none_match:
+            version = load_version()
+            etag = '%s-%s' % (etag_prefix, version)
+            if version is not None and request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+        entry = load()
+        cache.set(key, entry)
+
+    body, version, modified = entry
+    return versioned_response({name: body}, '%s-%s' % (etag_prefix, version), modified)
+
+# Give every other successful, buffered GET response an ETag from a hash of its body
+@app.after_request
+def add_etag(response):
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed \
+            and 'ETag' not in response.headers:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
 # Base URL
 @app.route('/')
 @app.route('/api')
@@ -26,36 +281,34 @@ class Users(Resource):
     Methods: GET, POST
     """
 
-    # Initialize POST request parser
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('first_name', type = str, required = True,
-            help = 'First name not provided')
-        self.reqparse.add_argument('last_name', type = str, required = True,
-            help = 'Last name not provided')
-        self.reqparse.add_argument('email', type = str, required = True,
-            help = 'Email address not provided')
-        self.reqparse.add_argument('password', type = str, required = True,
-            help = 'Password not provided')
-        super(Users, self).__init__()
-
-    # Return list of users
+    # Return list of users, optionally paginated or streamed, or the users in ?id=1,2,...
     def get(self):
-        return {'users': list(map(lambda x: UserModel.serialize(x), UserModel.query.all()))}
+        source = shards.merged(serializers.users)
+        if 'id' in request.args:
+            return batch_get('users', serializers.users, 'id', int, source)
+        if 'stream' in request.args:
+            return stream('users', serializers.users, source)
+        return paginate('users', serializers.users, int, source)
 
     # Add new user
+    # With more than one shard, the id is allocated from the directory and decides the user's shard
     def post(self):
-        data = self.reqparse.parse_args()
-
-        if UserModel.query.filter_by(email=data['email']).first() is not None:
+        data = schemas.new_user.parse()
+
+        id = None
+        if shards.sharded():
+            id = allocate_user_id(data['email'])
+            if id is None:
+                return { "message": "User with this email already exists" }, 409
+        elif UserModel.query.filter_by(email=data['email']).first() is not None:
             return { "message": "User with this email already exists" }, 409
-        
-        user = UserModel(email = data['email'], first_name = data['first_name'], last_name = data['last_name'])
-        user.set_password(data['password'])
-        user.add_to_db()
-        commit()
 
-        return { 'user': UserModel.serialize(user) }, 201
+        user = UserModel(id = id, email = data['email'], first_name = data['first_name'], last_name = data['last_name'])
+        user.set_password(data['password'])
+        with shards.using(shards.shard_for(id) if id is not None else None):
+            user.add_to_db()
+            commit()
+            return { 'user': UserModel.serialize(user) }, 201
 
 class User(Resource):
     """
@@ -66,8 +319,20 @@ class User(Resource):
 
     # Return user info for user <id>
     def get(self, id):
-        user = UserModel.query.get_or_404(id)
-        return { 'user': UserModel.serialize(user) }
+        user = cached('user:%d' % id, lambda: UserModel.serialize(UserModel.query.get_or_404(id)))
+        return { 'user': user }
+
+class Token(Resource):
+    """
+    Resource: token
+    Endpoint: /api/token
+    Methods: GET
+    """
+
+    # Return a short-lived bearer token for the authenticated user
+    @basic_auth.login_required
+    def get(self):
+        return { 'token': token_signer.dumps(g.user), 'expires_in': token_signer.ttl }
 
 class Books(Resource):
     """
@@ -76,42 +341,56 @@ class Books(Resource):
     Methods: GET, POST
     """
 
-    # Initialize POST request parser
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('title', type = str, required = True,
-            help = "Title not provided")
-        self.reqparse.add_argument('author', type = str, required = True,
-            help = "Author not provided")
-        self.reqparse.add_argument('isbn', type = str, required = True,
-            help = "ISBN not provided")
-        self.reqparse.add_argument('pub_date', type = str, required = True,
-            help = "Publication date not provided")
-        super(Books, self).__init__()
-
-    # Return list of books
+    # Return list of books, optionally paginated, streamed or searched, or the books in ?isbn=a,b,...
     def get(self):
-        return {'books': list(map(lambda x: BookModel.serialize(x), BookModel.query.all()))}
+        if 'isbn' in request.args:
+            return batch_get('books', serializers.books, 'isbn', schemas.normalize_isbn, catalog.current())
+        if any(arg in request.args for arg in search_args):
+            return search()
+        if 'stream' in request.args:
+            return stream('books', serializers.books)
+        return paginate('books', serializers.books, str, catalog.current())
     
     # Add new book
     def post(self):
-        data = self.reqparse.parse_args()
-        
-        # Publication date validation
-        try:
-            pub_date = datetime.strptime(data['pub_date'], '%Y-%m-%d')
-        except:
-            return { "message": "Publication date (pub_date) must be in YYYY-mm-dd format" }, 400
-            
+        data = schemas.new_book.parse()
+
         if BookModel.query.filter_by(isbn=data['isbn']).first() is not None:
             return { "message": "Book with this ISBN already exists" }, 409
 
-        book = BookModel(isbn = data['isbn'], title = data['title'], author = data['author'], pub_date = pub_date)
+        book = BookModel(isbn = data['isbn'], title = data['title'], author = data['author'], pub_date = data['pub_date'])
         book.add_to_db()
+        record_change('book', book.isbn)
         commit()
+        cache.delete('book:' + book.isbn)
 
         return { 'book': BookModel.serialize(book) }, 201
 
+class BooksImport(Resource):
+    """
+    Resource: books
+    Endpoint: /api/books/import
+    Methods: POST
+    """
+
+    # Bulk import books from a JSON array, NDJSON or CSV body
+    # Rows with a user_id are also added to that user's wishlist, which must be the authenticated user
+    @auth.login_required
+    def post(self):
+        formats = {
+            'application/json': 'json',
+            'application/x-ndjson': 'ndjson',
+            'text/csv': 'csv'
+        }
+        if request.mimetype not in formats:
+            return { "message": "Content type must be application/json, application/x-ndjson or text/csv" }, 415
+
+        try:
+            rows = read_rows(io.TextIOWrapper(request.stream, encoding='utf-8'), formats[request.mimetype])
+            return import_books(rows, allowed_user_id=g.user_id)
+        except ValueError as e:
+            return { "message": "Invalid import data: " + str(e) }, 400
+
 class Book(Resource):
     """
     Resource: books
@@ -121,8 +400,49 @@ class Book(Resource):
 
     # Return book info for book <isbn>
     def get(self, isbn):
-        book = BookModel.query.get_or_404(isbn)
-        return { 'book': BookModel.serialize(book) }
+        return conditional_get('book', 'book:%s' % isbn, 'book-%s' % isbn, lambda: load_book(isbn),
+            lambda: book_version(isbn))
+
+# Wishlist writes, run by write() once the request has been validated
+# Each returns (response body, status, cache keys to delete once it is committed)
+
+def add_wishlist_book(id, data):
+    # If book isn't in database, add it, otherwise ensure the attributes match up
+    if insert_book(data['isbn'], data['title'], data['author'], data['pub_date']):
+        record_change('book', data['isbn'])
+    else:
+        # Read it where it was written, in case it was added earlier in the same (queued) batch
+        with shards.using(None):
+            book = BookModel.query.with_entities(BookModel.title, BookModel.author, BookModel.pub_date) \
+                .filter_by(isbn=data['isbn']).first()
+        if tuple(book) != (data['title'], data['author'], data['pub_date']):
+            return { "message": "Different book with this ISBN already exists" }, 409, []
+
+    # Ensure book isn't already in wishlist
+    if not add_to_wishlist(id, data['isbn']):
+        return { "message": "Book with this ISBN already in user's wishlist" }, 409, []
+    record_change('add', data['isbn'], id)
+    touch_wishlists([id])
+    return { 'book': BookModel.serialize(BookModel(**data)) }, 201, \
+        ['book:' + data['isbn'], 'wishlist:%d' % id, 'book_users:' + data['isbn']]
+
+def put_wishlist_book(id, isbn, data):
+    # Add the book or update it, then link it, each in one statement
+    upsert_book(isbn, data['title'], data['author'], data['pub_date'])
+    record_change('book', isbn)
+    if add_to_wishlist(id, isbn):
+        record_change('add', isbn, id)
+    # Every wishlist containing the book now has stale details
+    touch_wishlists_with_book(isbn)
+    stale = ['wishlist:%d' % user_id for user_id in wishlist_user_ids(isbn)]
+    return { "message": "User\'s book wishlist updated successfully" }, 200, ['book:' + isbn, 'book_users:' + isbn] + stale
+
+def remove_wishlist_book(id, isbn):
+    if not remove_from_wishlist(id, isbn):
+        return { "message": "Book with this ISBN not in user\'s wishlist" }, 404, []
+    record_change('remove', isbn, id)
+    touch_wishlists([id])
+    return { "message": "Book deleted from user\'s wishlist successfully" }, 200, ['wishlist:%d' % id, 'book_users:' + isbn]
 
 class UserBooks(Resource):
     """
@@ -131,59 +451,25 @@ class UserBooks(Resource):
     Methods: GET, POST
     """
 
-    # Initialize POST request parser
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('title', type = str, required = True,
-            help = "Title not provided")
-        self.reqparse.add_argument('author', type = str, required = True,
-            help = "Author not provided")
-        self.reqparse.add_argument('isbn', type = str, required = True,
-            help = "ISBN not provided")
-        self.reqparse.add_argument('pub_date', type = str, required = True,
-            help = "Publication date not provided")
-        super(UserBooks, self).__init__()
-
     # Return list of books on user's wishlist
     def get(self, id):
-        user = UserModel.query.get_or_404(id)
-        return { 'books': list(map(lambda x: BookModel.serialize(x), user.books)) }
+        return conditional_get('books', 'wishlist:%d' % id, 'wishlist-%d' % id, lambda: load_wishlist(id),
+            lambda: UserModel.query.with_entities(UserModel.wishlist_version).filter_by(id=id).scalar())
 
     # Add new book to user's wishlist
     # User can only add books to their own wishlist
     @auth.login_required
+    @idempotent
     def post(self, id):
-        data = self.reqparse.parse_args()
-
-        user = UserModel.query.get_or_404(id)
-
-        try:
-            pub_date = datetime.strptime(data['pub_date'], '%Y-%m-%d')
-        except:
-            return {"message": "Publication date (pub_date) must be in YYYY-mm-dd format" }, 400
+        data = schemas.new_book.parse()
 
         # Verify that user is adding book to their own wishlist
-        if UserModel.query.filter_by(id=id, email=g.user.email).first() is None:
+        # (an authenticated user always exists, so the lookup is only needed for other ids)
+        if g.user_id != id:
+            UserModel.query.get_or_404(id)
             return { "message": "Users are only allowed to add books to their own wishlist" }, 401
 
-        # If book isn't in database, add it
-        book = BookModel.query.filter_by(isbn=data['isbn']).first()            
-        if book is None:
-            book = BookModel(isbn = data['isbn'], title = data['title'], author = data['author'], pub_date = pub_date)
-            book.add_to_db()
-        # Ensure book isn't already in wishlist and that the attributes match up
-        elif not(book.title == data['title'] and book.author == data['author'] and str(book.pub_date) == data['pub_date']):
-            print(book.pub_date)
-            print(data['pub_date'])
-
-            return { "message": "Different book with this ISBN already exists" }, 409
-        elif book in user.books:
-            return { "message": "Book with this ISBN already in user's wishlist" }, 409
-
-        user.books.append(book)
-        commit()
-
-        return { 'book': BookModel.serialize(book) }, 201
+        return write(add_wishlist_book, id, data)
 
 class UserBook(Resource):
     """
@@ -192,74 +478,100 @@ class UserBook(Resource):
     Methods: GET, PUT, DELETE
     """
 
-    # Initialize PUT request parser
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
-        self.reqparse.add_argument('title', type = str, required = True,
-            help = "Title not provided")
-        self.reqparse.add_argument('author', type = str, required = True,
-            help = "Author not provided")
-        self.reqparse.add_argument('pub_date', type = str, required = True,
-            help = "Publication date not provided")
-        super(UserBook, self).__init__()
-
     # Return book info for book <isbn> in user <id>'s wishlist
     def get(self, id, isbn):
-        user = UserModel.query.get_or_404(id)
-        book = BookModel.query.get_or_404(isbn)
-        if book not in user.books:
+        wishlist_version = UserModel.query.with_entities(UserModel.wishlist_version).filter_by(id=id).scalar()
+        if wishlist_version is None:
+            abort(404)
+        book, version, modified = cached('book:%s' % isbn, lambda: load_book(isbn))
+        if not in_wishlist(id, book['isbn']):
             return { "message": "Book with this ISBN not in user\'s wishlist" }, 404
-        return { 'book': BookModel.serialize(book) }
+        etag = 'wishlist-%d-book-%s-%d-%d' % (id, book['isbn'], wishlist_version, version)
+        return versioned_response({ 'book': book }, etag, modified)
 
     # Update book info for book <isbn> in user <id>'s wishlist
     # User can only update books in their own wishlist
     @auth.login_required
+    @idempotent
     def put(self, id, isbn):
-        data = self.reqparse.parse_args()
-
-        user = UserModel.query.get_or_404(id)
+        data = schemas.book_update.parse()
 
-        if UserModel.query.filter_by(id=id, email=g.user.email).first() is None:
+        if g.user_id != id:
+            UserModel.query.get_or_404(id)
             return { "message": "Users are only allowed to update books in their own wishlist" }, 401
 
-        try:
-            pub_date = datetime.strptime(data['pub_date'], '%Y-%m-%d')
-        except:
-            return { "message": "Publication date (pub_date) must be in YYYY-mm-dd format" }, 400
-
-        # If book isn't in database, add it
-        book = BookModel.query.filter_by(isbn=isbn).first()  
-        if book is None:
-            book = BookModel(isbn = isbn, title = data['title'], author = data['author'], pub_date = pub_date)
-            book.add_to_db()
-        else:
-            book.isbn=isbn
-            book.title = data['title']
-            book.author = data['author']
-            book.pub_date = pub_date
-
-        user.books.append(book)
-        commit()
-
-        return { "message": "User\'s book wishlist updated successfully" }
+        return write(put_wishlist_book, id, str(isbn), data)
 
     # Delete book <isbn> from user <id>'s wishlist
     # Users can only delete books from their own wishlist
     @auth.login_required
+    @idempotent
     def delete(self, id, isbn):
-        user = UserModel.query.get_or_404(id)
-        book = BookModel.query.get_or_404(isbn)
-
-        if UserModel.query.filter_by(id=id, email=g.user.email).first() is None:
+        if g.user_id != id:
+            UserModel.query.get_or_404(id)
             return { "message": "Users are only allowed to delete books from their own wishlist" }, 401
 
-        if book not in user.books:
-            return { "message": "Book with this ISBN not in user\'s wishlist" }, 404
+        book = BookModel.query.get_or_404(isbn)
+        return write(remove_wishlist_book, id, book.isbn)
 
-        user.books.remove(book)
-        commit()
+class PopularBooks(Resource):
+    """
+    Resource: books
+    Endpoint: /api/books/popular
+    Methods: GET
+    """
+
+    # Return the ?limit= (default 10) books on the most wishlists, read from the wish_count index
+    def get(self):
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            abort(400, message="Number of books (limit) must be an integer")
+        if limit < 1:
+            abort(400, message="Number of books (limit) must be a positive integer")
+        limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+        rows = serializers.books.query().add_columns(BookModel.wish_count) \
+            .order_by(BookModel.wish_count.desc(), BookModel.isbn).limit(limit)
+        return { 'books': [dict(serializers.book_dict(row), wish_count=row.wish_count) for row in rows] }
+
+class Changes(Resource):
+    """
+    Resource: changes
+    Endpoint: /api/changes
+    Methods: GET
+    """
 
-        return { "message": "Book deleted from user\'s wishlist successfully" }
+    # Return up to ?limit= changes after seq ?since=, optionally only those for ?user_id=
+    # With ?wait=<seconds>, wait up to CHANGES_MAX_WAIT seconds for a change if there are none yet
+    def get(self):
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+            user_id = request.args.get('user_id')
+            user_id = int(user_id) if user_id is not None else None
+            wait = float(request.args.get('wait', 0))
+            # nan and inf would never reach the deadline
+            if not math.isfinite(wait):
+                raise ValueError(wait)
+        except ValueError:
+            abort(400, message="since, limit and user_id must be integers and wait a number of seconds")
+        if limit < 1:
+            abort(400, message="Number of changes (limit) must be a positive integer")
+        limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+        # Clients that have fallen behind the pruned log must download the full lists again,
+        # then carry on from head
+        oldest, head = feed.seq_range()
+        if since > head:
+            abort(400, message="since must not be after the latest change (%d)" % head)
+        if oldest is not None and since < oldest - 1:
+            return { "message": "Changes since %d have been pruned" % since, 'oldest': oldest, 'head': head }, 410
+
+        rows = feed.wait_for_changes(since, limit, user_id, min(max(wait, 0), app.config['CHANGES_MAX_WAIT']))
+        if wait > 0:
+            oldest, head = feed.seq_range()
+        return { 'changes': rows, 'next': rows[-1]['seq'] if rows else since, 'oldest': oldest, 'head': head }
 
 class BookUsers(Resource):
     """
@@ -268,17 +580,43 @@ class BookUsers(Resource):
     Methods: GET
     """
 
-    # Return list of users with book <isbn> in their wishlist
+    # Return list of users with book <isbn> in their wishlist, or only their number with ?count=true
     def get(self, isbn):
-        book = BookModel.query.get_or_404(isbn)
+        if request.args.get('count') == 'true':
+            count = BookModel.query.with_entities(BookModel.wish_count).filter_by(isbn=isbn).scalar()
+            if count is None:
+                abort(404)
+            return { 'isbn': isbn, 'count': count }
+
+        def load():
+            BookModel.query.with_entities(BookModel.isbn).filter_by(isbn=isbn).first_or_404()
+            return serializers.book_users(isbn)
+        return { 'users': cached('book_users:' + isbn, load) }
+
+class CacheStats(Resource):
+    """
+    Resource: cache
+    Endpoint: /api/cache
+    Methods: GET
+    """
+
+    # Return cache hit, miss and eviction counters
+    def get(self):
+        return { 'cache': cache.stats() }
 
-        return { 'users': list(map(lambda x: UserModel.serialize(x), book.users)) }
+# Encode JSON responses with the configured JSON_BACKEND
+api.representation('application/json')(output_json)
 
 # Add API resources and corresponding endpoints
 api.add_resource(Users, '/users', endpoint = 'users')
 api.add_resource(User, '/users/<int:id>', endpoint = 'user')
+api.add_resource(Token, '/token', endpoint = 'token')
 api.add_resource(Books, '/books', endpoint = 'books')
+api.add_resource(BooksImport, '/books/import', endpoint = 'books import')
+api.add_resource(PopularBooks, '/books/popular', endpoint = 'popular books')
 api.add_resource(Book, '/books/<int:isbn>', endpoint = 'book')
 api.add_resource(UserBooks, '/users/<int:id>/books', endpoint = 'user books list')
 api.add_resource(UserBook, '/users/<int:id>/books/<int:isbn>', endpoint = 'user book')
-api.add_resource(BookUsers, '/books/<isbn>/users', endpoint = 'book users list')
\ No newline at end of file
+api.add_resource(BookUsers, '/books/<isbn>/users', endpoint = 'book users list')
+api.add_resource(Changes, '/changes', endpoint = 'changes')
+api.add_resource(CacheStats, '/cache', endpoint = 'cache')
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Write-behind queue with group commit for wishlist writes, enabled with WRITE_QUEUE_ENABLED
+Request threads validate a write, hand it to a single writer thread and wait. The writer
+takes whatever has queued up, at most WRITE_BATCH_SIZE writes or WRITE_BATCH_WINDOW seconds'
+worth, runs each in its own savepoint inside one BEGIN IMMEDIATE transaction (one per database
+it writes to, with SHARD_COUNT > 1) and commits once.
+Every request in the batch is answered only after that commit, so responses mean the same as
+before while the database lock and fsync are paid once per batch instead of once per request.
+"""
+
+from .core import app, cache, db
+from . import shards
+from .models import commit
+import os
+import queue
+import threading
+import time
+
+class Operation(object):
+    """
+    A queued call of <function>(*<args>) on <shard>, answered once its batch is committed
+    """
+
+    def __init__(self, shard, function, args):
+        self.shard = shard
+        self.function = function
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class WriteQueue(object):
+    """
+    Queue of writes and the thread that group-commits them
+    The thread is started on first use in each process, so preforked workers get their own.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.queue = None
+        self.lock = threading.Lock()
+        self.pid = None
+        self.batches = 0
+        self.operations = 0
+
+    def start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked worker doesn't inherit the writer thread or anything queued for it
+                self.queue = queue.Queue(self.app.config['WRITE_QUEUE_SIZE'])
+                threading.Thread(target=self.run, name='wishlist-writer', daemon=True).start()
+                self.pid = os.getpid()
+
+    # Run <function>(*<args>) on <shard> in the next batch and return its result once the batch is durable
+    def submit(self, shard, function, *args):
+        if self.pid != os.getpid():
+            self.start()
+        operation = Operation(shard, function, args)
+        self.queue.put(operation)
+        operation.done.wait()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.app.config['WRITE_BATCH_WINDOW']
+        while len(batch) < self.app.config['WRITE_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            self.apply(self.next_batch())
+
+    def apply(self, batch):
+        with self.app.app_context():
+            try:
+                # Take the write lock once for the whole batch
+                db.session.execute('BEGIN IMMEDIATE')
+                # Begin the transactions of the shards it writes to as well: a savepoint outside a
+                # transaction would begin one, and releasing it commit the request's writes early.
+                # Deferred, since BEGIN IMMEDIATE would also lock the main database they attach; each
+                # shard is locked by its first write, after the main database (see shards.lock_main()).
+                if shards.sharded():
+                    for shard in sorted(set(operation.shard for operation in batch) - {None}):
+                        shards.call(shard, db.session.execute, 'BEGIN')
+                for operation in batch:
+                    savepoint = db.session.begin_nested()
+                    try:
+                        operation.result = shards.call(operation.shard, operation.function, *operation.args)
+                    except Exception as e:
+                        operation.error = e
+                    # Failed and rejected writes are undone without affecting the rest of the batch
+                    if operation.error is not None or operation.result[1] >= 400:
+                        savepoint.rollback()
+                    else:
+                        savepoint.commit()
+                commit()
+            except Exception as e:
+                db.session.rollback()
+                for operation in batch:
+                    operation.error = operation.error or e
+            finally:
+                db.session.remove()
+                self.batches += 1
+                self.operations += len(batch)
+                for operation in batch:
+                    operation.done.set()
+
+write_queue = WriteQueue(app)
+
+# Run wishlist write <operation>(*<args>), which returns (body, status, stale cache keys),
+# and commit it, through the write queue if it's enabled. Rejected writes (status 400 and up)
+# are rolled back. Returns (body, status) for the response.
+def write(operation, *args):
+    if app.config['WRITE_QUEUE_ENABLED']:
+        # Give this request's connection back while it waits, so requests can't take
+        # every pooled connection and leave the writer without one
+        db.session.close()
+        # The writer thread runs it on the shard this request was routed to
+        body, status, stale = write_queue.submit(shards.current(), operation, *args)
+    else:
+        shards.lock_main()
+        body, status, stale = operation(*args)
+        if status >= 400:
+            db.session.rollback()
+        else:
+            commit()
+    cache.delete(*stale)
+    return body, status
@@ -0,0 +1,313 @@
+"""
+Load-testing and benchmark harness for the books wishlist API
+Generates a synthetic catalog (books, users and Zipf-distributed wishlists) in a temporary
+SQLite database, drives every resource through the Flask test client under configurable
+concurrency and reports latency percentiles, throughput and peak RSS as JSON.
+With --startup it instead measures, in fresh processes, how long `import api`, create_app(),
+the startup() phase and the first requests take, with and without running startup() first.
+
+    python benchmark.py --books 100000 --concurrency 8 --output bench.json
+    python benchmark.py --books 100000 --baseline bench.json
+    python benchmark.py --startup --output startup.json
+"""
+
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import date, datetime, timedelta
+from itertools import accumulate, count
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+password = 'benchmark'
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def peak_rss_kb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+# Fill the app's database with <books> books, <users> users and Zipf-distributed wishlists
+# Rows are inserted directly for speed, so the columns the app maintains on writes (wish
+# counts and change timestamps) are filled in here to match
+def generate_catalog(app, db, path, books, users, wishlist_size, zipf, seed):
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(seed)
+    with app.app_context():
+        db.create_all()
+    first_date = date(1900, 1, 1)
+
+    isbns = ['978%010d' % i for i in range(books)]
+    # Book popularity follows a Zipf distribution: the book at rank k is wished for in proportion to 1 / k^s
+    cum_weights = list(accumulate(1.0 / (rank ** zipf) for rank in range(1, books + 1)))
+    links = set()
+    for user_id in range(1, users + 1):
+        for isbn in rng.choices(isbns, cum_weights=cum_weights, k=rng.randint(0, 2 * wishlist_size)):
+            links.add((user_id, isbn))
+    wish_counts = Counter(isbn for user_id, isbn in links)
+    # Stored the way SQLAlchemy stores DateTime columns
+    now = datetime.utcnow().isoformat(' ')
+
+    connection = sqlite3.connect(path)
+    rows = ((isbn, 'Title %d %s' % (i, rng.choice(words)), 'Author %d' % rng.randrange(max(1, books // 20)),
+             (first_date + timedelta(days=rng.randrange(45000))).isoformat(), now, wish_counts[isbn])
+            for i, isbn in enumerate(isbns))
+    connection.executemany('INSERT INTO books (isbn, title, author, pub_date, version, updated_at, wish_count) '
+        'VALUES (?, ?, ?, ?, 1, ?, ?)', rows)
+
+    # Every user shares one password so the catalog doesn't take hours of PBKDF2 to build
+    password_hash = generate_password_hash(password)
+    connection.executemany('INSERT INTO users (id, first_name, last_name, email, password_hash, wishlist_version, '
+        'wishlist_updated_at) VALUES (?, ?, ?, ?, ?, 1, ?)',
+        ((i, 'First%d' % i, 'Last%d' % i, 'user%d@example.com' % i, password_hash, now) for i in range(1, users + 1)))
+    connection.executemany('INSERT INTO user_books (user_id, isbn) VALUES (?, ?)', links)
+    connection.commit()
+    connection.close()
+
+    return isbns, sorted(links)
+
+words = ['lord', 'rings', 'ocean', 'winter', 'garden', 'night', 'river', 'empire', 'glass', 'storm']
+
+# Each scenario returns a request (method, url, kwargs) for one iteration
+# delete_user_book removes each generated link once, so it runs last and the others still find them
+def scenarios(isbns, links, users, seed):
+    def auth(user_id):
+        credentials = 'user%d@example.com:%s' % (user_id, password)
+        return {'Authorization': 'Basic ' + b64encode(credentials.encode('UTF-8')).decode('ascii')}
+
+    # Numbered from one counter, so books and users added by different scenarios and threads never clash
+    numbers = count()
+
+    def new_book(rng):
+        return {'isbn': '979%013d' % next(numbers), 'title': 'Benchmark', 'author': 'Benchmark',
+            'pub_date': '2018-10-16'}
+
+    def new_user(rng):
+        number = next(numbers)
+        return {'first_name': 'Bench', 'last_name': str(number), 'email': 'bench%d@example.com' % number,
+            'password': password}
+
+    # 100 new books, the first 10 also added to the importing user's wishlist
+    def books_import(rng):
+        user_id = rng.randint(1, users)
+        rows = [dict(new_book(rng), user_id=user_id) if i < 10 else new_book(rng) for i in range(100)]
+        return ('POST', '/api/books/import', {'data': ''.join(json.dumps(row) + '\n' for row in rows),
+            'content_type': 'application/x-ndjson', 'headers': auth(user_id)})
+
+    deletions = list(links)
+    random.Random(seed).shuffle(deletions)
+    deletions = iter(deletions)
+    def delete_user_book(rng):
+        link = next(deletions, None) or rng.choice(links)
+        return ('DELETE', '/api/users/%d/books/%s' % link, {'headers': auth(link[0])})
+
+    return {
+        'users_page': lambda rng: ('GET', '/api/users?limit=100&after=%d' % rng.randrange(users), {}),
+        'user': lambda rng: ('GET', '/api/users/%d' % rng.randint(1, users), {}),
+        'books_page': lambda rng: ('GET', '/api/books?limit=100&after=' + rng.choice(isbns), {}),
+        'book': lambda rng: ('GET', '/api/books/' + rng.choice(isbns), {}),
+        'books_search': lambda rng: ('GET', '/api/books?q=' + rng.choice(words), {}),
+        'user_books': lambda rng: ('GET', '/api/users/%d/books' % rng.randint(1, users), {}),
+        'user_book': lambda rng: (lambda link: ('GET', '/api/users/%d/books/%s' % link, {}))(rng.choice(links)),
+        'book_users': lambda rng: ('GET', '/api/books/%s/users' % rng.choice(isbns[:100]), {}),
+        'post_user_book': lambda rng: (lambda user_id: ('POST', '/api/users/%d/books' % user_id,
+            {'data': new_book(rng), 'headers': auth(user_id)}))(rng.randint(1, users)),
+        'put_user_book': lambda rng: (lambda link: ('PUT', '/api/users/%d/books/%s' % link,
+            {'data': {'title': 'Updated', 'author': 'Updated', 'pub_date': '2018-10-16'}, 'headers': auth(link[0])}))(rng.choice(links)),
+        'token': lambda rng: ('GET', '/api/token', {'headers': auth(rng.randint(1, users))}),
+        'post_user': lambda rng: ('POST', '/api/users', {'data': new_user(rng)}),
+        'post_book': lambda rng: ('POST', '/api/books', {'data': new_book(rng)}),
+        'books_import': books_import,
+        'delete_user_book': delete_user_book
+    }
+
+# Send <requests> requests built by <scenario> from <concurrency> threads
+def run_scenario(app, scenario, requests, concurrency, seed):
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(seed + index)
+        latencies = []
+        errors = 0
+        for _ in range(requests // concurrency + (1 if index < requests % concurrency else 0)):
+            method, url, kwargs = scenario(rng)
+            start = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for worker_latencies, errors in results for latency in worker_latencies)
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors for worker_latencies, errors in results),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'rps': round(len(latencies) / elapsed, 1)
+    }
+
+# Run in a fresh process by measure_startup(): time each phase of starting the app on the
+# database at <path> and serving its first two requests, and print them as JSON
+def probe_startup(path, run_startup):
+    start = time.perf_counter()
+    import api
+    imported = time.perf_counter()
+    app = api.create_app()
+    created = time.perf_counter()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['CATALOG_SNAPSHOT'] = path + '.catalog'
+    if run_startup:
+        api.startup()
+    started = time.perf_counter()
+
+    client = app.test_client()
+    timings = []
+    for _ in range(2):
+        request_start = time.perf_counter()
+        response = client.get('/api/books?limit=100')
+        timings.append(time.perf_counter() - request_start)
+        if response.status_code != 200:
+            raise RuntimeError('GET /api/books returned %d' % response.status_code)
+
+    print(json.dumps({
+        'import_ms': (imported - start) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'startup_ms': (started - created) * 1000,
+        'first_request_ms': timings[0] * 1000,
+        'second_request_ms': timings[1] * 1000,
+        'ready_ms': (started - start + timings[0]) * 1000
+    }))
+
+# Median timings of <runs> fresh processes starting the app on the database at <path>,
+# with ('warm') and without ('cold') the startup() phase
+def measure_startup(path, runs):
+    def probe(run_startup):
+        command = [sys.executable, os.path.abspath(__file__), '--startup-probe', path]
+        if not run_startup:
+            command.append('--cold')
+        output = subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return json.loads(output.decode('UTF-8').splitlines()[-1])
+
+    # Not timed: writes the catalog snapshot the other runs load
+    probe(True)
+    results = {}
+    for mode, run_startup in (('cold', False), ('warm', True)):
+        samples = [probe(run_startup) for _ in range(runs)]
+        results[mode] = {metric: round(statistics.median(sample[metric] for sample in samples), 3)
+            for metric in samples[0]}
+    return results
+
+# Return the scenarios whose p95 latency rose, or throughput fell, by more than <threshold>
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if previous is None:
+            continue
+        if result['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append({'scenario': name, 'metric': 'p95_ms', 'baseline': previous['p95_ms'], 'current': result['p95_ms']})
+        if result['rps'] < previous['rps'] * (1 - threshold):
+            regressions.append({'scenario': name, 'metric': 'rps', 'baseline': previous['rps'], 'current': result['rps']})
+    for mode, result in results.get('startup', {}).items():
+        previous = baseline.get('startup', {}).get(mode)
+        if previous is None:
+            continue
+        for metric in ('import_ms', 'first_request_ms', 'ready_ms'):
+            if result[metric] > previous[metric] * (1 + threshold):
+                regressions.append({'scenario': 'startup_' + mode, 'metric': metric, 'baseline': previous[metric], 'current': result[metric]})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every books wishlist API endpoint')
+    parser.add_argument('--books', type=int, default=10000, help='number of books to generate')
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--wishlist-size', type=int, default=20, help='mean number of books per wishlist')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of book popularity')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--scenario', action='append', help='only run these scenarios (repeatable)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write results JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='compare against results JSON from an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+    parser.add_argument('--write-queue', action='store_true', help='group-commit wishlist writes (WRITE_QUEUE_ENABLED)')
+    parser.add_argument('--startup', action='store_true', help='measure import time and first-request latency instead of the scenarios')
+    parser.add_argument('--startup-runs', type=int, default=5, help='fresh processes per --startup measurement')
+    parser.add_argument('--startup-probe', help=argparse.SUPPRESS)
+    parser.add_argument('--cold', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_probe:
+        probe_startup(args.startup_probe, not args.cold)
+        return 0
+
+    directory = tempfile.mkdtemp(prefix='books_wishlist_bench_')
+    path = os.path.join(directory, 'bench.db')
+    db = None
+    try:
+        from api import app, db
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        app.config['WRITE_QUEUE_ENABLED'] = args.write_queue
+
+        start = time.perf_counter()
+        isbns, links = generate_catalog(app, db, path, args.books, args.users, args.wishlist_size, args.zipf, args.seed)
+        setup_seconds = time.perf_counter() - start
+
+        available = scenarios(isbns, links, args.users, args.seed)
+        names = [] if args.startup else args.scenario or list(available)
+        results = {
+            'parameters': {key: value for key, value in vars(args).items()
+                if key not in ('output', 'baseline', 'startup_probe', 'cold')},
+            'setup_seconds': round(setup_seconds, 3),
+            'scenarios': {}
+        }
+        for name in names:
+            results['scenarios'][name] = run_scenario(app, available[name], args.requests, args.concurrency, args.seed)
+        if args.startup:
+            db.dispose_engines()
+            results['startup'] = measure_startup(path, args.startup_runs)
+        # Process-wide, so it's the peak over the whole run rather than any one scenario
+        results['peak_rss_kb'] = peak_rss_kb()
+
+        regressions = []
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.threshold)
+            results['regressions'] = regressions
+
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+        return 1 if regressions else 0
+    finally:
+        if db is not None:
+            db.dispose_engines()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,8 @@
-from api import app
\ No newline at end of file
+from api import create_app
+
+app = create_app()
+
+# Production server, see api/server.py
+if __name__ == "__main__":
+    from api.server import run
+    run()
\ No newline at end of file
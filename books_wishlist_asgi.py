@@ -0,0 +1 @@
+from api.asgi import application
\ No newline at end of file
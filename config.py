@@ -2,4 +2,68 @@ class Config(object):
     SECRET_KEY = 'super-secret-key'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     TESTING = False
-    DATABASE = 'database.db'
\ No newline at end of file
+    DATABASE = 'database.db'
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    STREAM_BATCH_SIZE = 1000
+    CREDENTIAL_CACHE_SIZE = 1024
+    CREDENTIAL_CACHE_TTL = 300
+    TOKEN_TTL = 600
+    BULK_BATCH_SIZE = 5000
+    BULK_COMMIT_SIZE = 100000
+    BULK_MAX_ERRORS = 1000
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY'
+    }
+    SQLITE_POOL_SIZE = 5
+    SQLITE_MAX_OVERFLOW = 10
+    SQLITE_READ_POOL_SIZE = 10
+    CACHE_BACKEND = 'lru'
+    CACHE_MAX_SIZE = 10000
+    CACHE_TTL = 300
+    CACHE_REDIS_URL = 'redis://localhost:6379/0'
+    JSON_BACKEND = 'json'
+    METRICS_ENABLED = True
+    PROFILE_ENABLED = False
+    PROFILE_SAMPLE_RATE = 0.1
+    PROFILE_THRESHOLD = 0.5
+    PROFILE_DIR = 'profiles'
+    ASGI_THREADS = 10
+    SERVER_BIND = '127.0.0.1:8000'
+    SERVER_WORKERS = 0
+    SERVER_WORKER_CLASS = 'sync'
+    SERVER_THREADS = 1
+    SERVER_TIMEOUT = 30
+    SERVER_GRACEFUL_TIMEOUT = 30
+    CACHE_WARM_SIZE = 1000
+    BATCH_MAX_KEYS = 1000
+    CATALOG_ENABLED = False
+    CATALOG_SNAPSHOT = 'catalog.snapshot'
+    CATALOG_REFRESH_INTERVAL = 1.0
+    COMPRESSION_ENABLED = True
+    COMPRESSION_CODECS = ('zstd', 'br', 'gzip')
+    COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+    COMPRESSION_MIN_SIZE = 1024
+    IDEMPOTENCY_CACHE_SIZE = 10000
+    IDEMPOTENCY_TTL = 86400
+    CHANGES_MAX_WAIT = 30
+    CHANGES_POLL_INTERVAL = 1.0
+    WRITE_QUEUE_ENABLED = False
+    WRITE_QUEUE_SIZE = 10000
+    WRITE_BATCH_SIZE = 256
+    WRITE_BATCH_WINDOW = 0.002
+    SHARD_COUNT = 1
+    RATE_LIMIT_ENABLED = False
+    RATE_LIMIT_RATE = 20
+    RATE_LIMIT_BURST = 200
+    RATE_LIMIT_COSTS = {'default': 1, 'full list': 50, 'password': 10, 'books import': 50}
+    RATE_LIMIT_SLOTS = 65536
+    ADMISSION_ENABLED = False
+    ADMISSION_MAX_IN_FLIGHT = 64
+    ADMISSION_MAX_LATENCY = 2.0
+    ADMISSION_RETRY_AFTER = 1
\ No newline at end of file
@@ -2,8 +2,28 @@ import unittest
 import os
 import json
 from base64 import b64encode
-from api import app, db
+from api import app, db, cache, catalog, compression, feed, limits, migrations, serializers, server, shards, writer
+from api.models import UserModel, BookModel, reconcile_wish_counts, record_change, upsert_book
+from api.cache import CacheBackend
+from api.idempotency import results
+from api.metrics import registry
+from api.writer import Operation, write_queue
 from flask_sqlalchemy import SQLAlchemy
+from urllib.parse import urlencode
+from datetime import datetime
+import asyncio
+import multiprocessing
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from api import asgi
+except ImportError:
+    asgi = None
 
 class BooksWishlistTestCase(unittest.TestCase):
     """
@@ -112,6 +132,209 @@ class BooksWishlistTestCase(unittest.TestCase):
         self.assertIn(self.second_book['author'], str(get_response.data))
         self.assertIn(self.second_book['pub_date'], str(get_response.data))
 
+    # Test /api/users and /api/books pagination
+    def test_pagination(self):
+        # Add users and books
+        for user in (self.user_one, self.user_two):
+            response = self.client().post('/api/users', data=user)
+            self.assertEqual(response.status_code, 201)
+        for book in (self.first_book, self.second_book, self.third_book):
+            response = self.client().post('/api/books', data=book)
+            self.assertEqual(response.status_code, 201)
+
+        # Verify first page of users and cursor for the next page
+        response = self.client().get('/api/users?limit=1')
+        self.assertEqual(response.status_code, 200)
+        page = json.loads(response.data)
+        self.assertEqual(len(page['users']), 1)
+        self.assertEqual(page['users'][0]['email'], self.user_one['email'])
+        self.assertEqual(page['next'], page['users'][0]['user_id'])
+
+        # Verify last page of users has no next cursor
+        response = self.client().get('/api/users?limit=1&after=' + str(page['next']))
+        page = json.loads(response.data)
+        self.assertEqual(page['users'][0]['email'], self.user_two['email'])
+        self.assertIsNone(page['next'])
+        response = self.client().get('/api/users?limit=1&after=' + str(page['users'][0]['user_id']))
+        self.assertEqual(json.loads(response.data)['users'], [])
+
+        # Walk every page of books in ISBN order
+        isbns = []
+        endpoint = '/api/books?limit=2'
+        while endpoint:
+            page = json.loads(self.client().get(endpoint).data)
+            isbns += [book['isbn'] for book in page['books']]
+            endpoint = page['next'] and '/api/books?limit=2&after=' + page['next']
+        self.assertEqual(isbns, sorted([self.first_book['isbn'], self.second_book['isbn'], self.third_book['isbn']]))
+
+        # Verify invalid pagination arguments are rejected
+        self.assertEqual(self.client().get('/api/users?limit=0').status_code, 400)
+        self.assertEqual(self.client().get('/api/users?after=abc').status_code, 400)
+
+    # Test /api/users and /api/books streaming
+    def test_streaming(self):
+        # Add books
+        for book in (self.first_book, self.second_book, self.third_book):
+            response = self.client().post('/api/books', data=book)
+            self.assertEqual(response.status_code, 201)
+
+        # Verify NDJSON stream returns one book per line
+        response = self.client().get('/api/books?stream=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual([json.loads(line)['isbn'] for line in lines], sorted([self.first_book['isbn'], self.second_book['isbn'], self.third_book['isbn']]))
+
+        # Verify JSON stream matches the unpaginated listing
+        response = self.client().get('/api/books?stream=json')
+        self.assertEqual(response.status_code, 200)
+        streamed = json.loads(response.data)['books']
+        listed = json.loads(self.client().get('/api/books').data)['books']
+        self.assertEqual(sorted(streamed, key=lambda x: x['isbn']), sorted(listed, key=lambda x: x['isbn']))
+
+        # Verify unknown stream formats are rejected
+        self.assertEqual(self.client().get('/api/users?stream=xml').status_code, 400)
+
+    # Test negotiated compression of buffered and streamed responses
+    def test_compression(self):
+        for book in (self.first_book, self.second_book, self.third_book):
+            self.assertEqual(self.client().post('/api/books', data=book).status_code, 201)
+        plain = self.client().get('/api/books')
+        app.config.update(COMPRESSION_MIN_SIZE=0)
+        try:
+            # Verify gzip bodies decompress to the identity body, with a weak ETag that still gives a 304
+            response = self.client().get('/api/books', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(zlib.decompress(response.data, 16 + zlib.MAX_WBITS), plain.data)
+            self.assertEqual(response.headers['ETag'], 'W/' + plain.headers['ETag'])
+            response = self.client().get('/api/books', headers={'Accept-Encoding': 'gzip',
+                'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+
+            # Verify streams are compressed with each available codec
+            decompress = {'gzip': lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                'br': lambda data: compression.brotli.decompress(data),
+                'zstd': lambda data: compression.zstandard.ZstdDecompressor().decompressobj().decompress(data)}
+            for codec in compression.codecs:
+                response = self.client().get('/api/books?stream=ndjson', headers={'Accept-Encoding': codec + ', identity;q=0.5'})
+                self.assertEqual(response.headers['Content-Encoding'], codec)
+                self.assertNotIn('Content-Length', response.headers)
+                self.assertEqual(len(decompress[codec](response.data).splitlines()), 3)
+
+            # Verify clients that don't accept a codec, and small bodies, are sent uncompressed
+            response = self.client().get('/api/books', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            app.config.update(COMPRESSION_MIN_SIZE=1024)
+            response = self.client().get('/api/books', headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, plain.data)
+        finally:
+            app.config.update(COMPRESSION_MIN_SIZE=1024)
+
+    # Test /api/books/import
+    def test_books_import(self):
+        # Add user, parse user ID, configure auth
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        user_one_id = json.loads(user_post_response.data)['user']['user_id']
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Import a JSON array with a wishlist link, a duplicate, a conflict and a bad date
+        linked_book = dict(self.second_book, user_id=user_one_id)
+        conflicting_book = dict(self.first_book, title='conflict')
+        bad_date_book = dict(self.third_book, pub_date='16-10-2018')
+        rows = [self.first_book, linked_book, self.first_book, conflicting_book, bad_date_book]
+        response = self.client().post('/api/books/import', data=json.dumps(rows),
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.data)
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['linked'], 1)
+        self.assertEqual([error['row'] for error in report['errors']], [4, 5])
+
+        # Verify imported books and wishlist link
+        response = self.client().get('/api/books/' + self.first_book['isbn'])
+        self.assertEqual(response.status_code, 200)
+        response = self.client().get('/api/users/' + str(user_one_id) + '/books')
+        self.assertIn(self.second_book['isbn'], str(response.data))
+        response = self.client().get('/api/books/' + self.second_book['isbn'] + '/users?count=true')
+        self.assertEqual(json.loads(response.data)['count'], 1)
+
+        # Import NDJSON and reject links to another user's wishlist
+        rows = [self.third_book, dict(self.first_book, user_id=user_one_id + 1)]
+        response = self.client().post('/api/books/import', data='\n'.join(map(json.dumps, rows)),
+            content_type='application/x-ndjson', headers=headers)
+        report = json.loads(response.data)
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(report['error_count'], 1)
+
+        # Import CSV with the CLI command
+        with open('test_import.csv', 'w') as f:
+            f.write('isbn,title,author,pub_date,user_id\n')
+            f.write('555,csv book,csv author,2001-02-03,' + str(user_one_id) + '\n')
+        try:
+            result = app.test_cli_runner().invoke(args=['import-books', 'test_import.csv'])
+        finally:
+            os.unlink('test_import.csv')
+        self.assertEqual(json.loads(result.output)['imported'], 1)
+        response = self.client().get('/api/users/' + str(user_one_id) + '/books')
+        self.assertIn('csv book', str(response.data))
+
+    # Test /api/books search and filters
+    def test_books_search(self):
+        # Add books
+        for book in (self.first_book, self.second_book, self.third_book):
+            response = self.client().post('/api/books', data=book)
+            self.assertEqual(response.status_code, 201)
+
+        # Verify full-text search matches title words and author prefixes
+        response = self.client().get('/api/books?q=three')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([book['isbn'] for book in json.loads(response.data)['books']], [self.third_book['isbn']])
+        response = self.client().get('/api/books?q=test%20cli')
+        self.assertEqual(len(json.loads(response.data)['books']), 3)
+
+        # Verify author and publication date filters
+        response = self.client().get('/api/books?author=test%20client')
+        isbns = [book['isbn'] for book in json.loads(response.data)['books']]
+        self.assertEqual(isbns, sorted([self.first_book['isbn'], self.second_book['isbn']]))
+        response = self.client().get('/api/books?q=book&published_after=2018-10-17')
+        self.assertEqual(json.loads(response.data)['books'], [])
+        response = self.client().get('/api/books?published_before=2018-10-16&limit=2')
+        page = json.loads(response.data)
+        self.assertEqual(len(page['books']), 2)
+        self.assertIsNotNone(page['next'])
+
+        # Verify ranked results page through the next cursor
+        response = self.client().get('/api/books?q=book&limit=2')
+        page = json.loads(response.data)
+        response = self.client().get('/api/books?q=book&limit=2&after=' + page['next'])
+        second_page = json.loads(response.data)
+        self.assertEqual(len(page['books'] + second_page['books']), 3)
+        self.assertIsNone(second_page['next'])
+
+        # Verify the index follows book updates
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_one_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        book_update = {'title': 'renamed', 'pub_date': '2018-10-10', 'author': 'updated'}
+        endpoint = '/api/users/' + user_one_id + '/books/' + self.third_book['isbn']
+        self.assertEqual(self.client().put(endpoint, data=book_update, headers=headers).status_code, 200)
+        self.assertEqual(json.loads(self.client().get('/api/books?q=three').data)['books'], [])
+        self.assertEqual(len(json.loads(self.client().get('/api/books?q=renamed').data)['books']), 1)
+
+        # Verify invalid searches are rejected
+        self.assertEqual(self.client().get('/api/books?q=%22').status_code, 400)
+        self.assertEqual(self.client().get('/api/books?published_after=yesterday').status_code, 400)
+
     # Test /api/books/<isbn>
     def test_book(self):
         # Add book and verify response
@@ -192,6 +415,38 @@ class BooksWishlistTestCase(unittest.TestCase):
         delete_response = self.client().delete(endpoint, headers=headers)
         self.assertEqual(delete_response.status_code, 200)
 
+    # Test wishlist membership checks on /api/users/<id>/books/<isbn>
+    def test_wishlist_membership(self):
+        # Add user, parse user ID, configure auth
+        user_post_response = self.client().post('/api/users', data=self.user_two)
+        self.assertEqual(user_post_response.status_code, 201)
+        user_two_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_two['email'] + ':' + self.user_two['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Add book twice and verify the duplicate is rejected
+        endpoint = '/api/users/' + user_two_id + '/books'
+        response = self.client().post(endpoint, data=self.first_book, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        response = self.client().post(endpoint, data=self.first_book, headers=headers)
+        self.assertEqual(response.status_code, 409)
+
+        # PUT on a book already in the wishlist keeps a single entry
+        endpoint = '/api/users/' + user_two_id + '/books/' + self.first_book['isbn']
+        book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+        response = self.client().put(endpoint, data=book_update, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client().get('/api/users/' + user_two_id + '/books')
+        self.assertEqual(len(json.loads(response.data)['books']), 1)
+
+        # Delete book and verify it is no longer in the wishlist
+        response = self.client().delete(endpoint, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client().get(endpoint).status_code, 404)
+        self.assertEqual(self.client().delete(endpoint, headers=headers).status_code, 404)
+
     # Test /api/books/<isbn>/users
     def test_book_users(self):
         # Add users and verify responses
@@ -225,6 +480,789 @@ class BooksWishlistTestCase(unittest.TestCase):
         self.assertIn(self.user_one['email'], str(response.data))
         self.assertIn(self.user_two['email'], str(response.data))
 
+    # Test /api/token and bearer token auth
+    def test_token(self):
+        # Add user, verify response and parse user ID
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        user_one_id = str(json.loads(user_post_response.data)['user']['user_id'])
+
+        # Fetch token using basic auth
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        token_response = self.client().get('/api/token', headers=headers)
+        self.assertEqual(token_response.status_code, 200)
+        token = json.loads(token_response.data)['token']
+
+        # Add book to wishlist using the bearer token and verify response
+        endpoint = '/api/users/' + user_one_id + '/books'
+        headers = {'Authorization': 'Bearer ' + token}
+        post_response = self.client().post(endpoint, data=self.first_book, headers=headers)
+        self.assertEqual(post_response.status_code, 201)
+
+        # Verify tampered tokens and wrong passwords are rejected
+        headers = {'Authorization': 'Bearer ' + token + 'x'}
+        post_response = self.client().post(endpoint, data=self.second_book, headers=headers)
+        self.assertEqual(post_response.status_code, 401)
+        auth_creds = self.user_one['email'] + ':wrong'
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        self.assertEqual(self.client().get('/api/token', headers=headers).status_code, 401)
+
+    # Test read-through cache and write invalidation
+    def test_cache(self):
+        # Add user, parse user ID, configure auth
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        user_one_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Populate cached wishlist and verify the second read is a hit
+        endpoint = '/api/users/' + user_one_id + '/books'
+        self.client().get(endpoint)
+        hits = cache.stats()['hits']
+        self.assertEqual(json.loads(self.client().get(endpoint).data)['books'], [])
+        self.assertEqual(cache.stats()['hits'], hits + 1)
+
+        # Verify a backend missing methods can't be created
+        class IncompleteCache(CacheBackend):
+            def get(self, key):
+                return None
+        with self.assertRaises(TypeError):
+            IncompleteCache()
+
+        # Verify adding, updating and deleting a book invalidate cached reads
+        response = self.client().post(endpoint, data=self.first_book, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(self.first_book['title'], str(self.client().get(endpoint).data))
+        book_endpoint = '/api/books/' + self.first_book['isbn']
+        self.assertIn(self.first_book['title'], str(self.client().get(book_endpoint).data))
+
+        book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+        response = self.client().put(endpoint + '/' + self.first_book['isbn'], data=book_update, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('updated', str(self.client().get(endpoint).data))
+        self.assertIn('updated', str(self.client().get(book_endpoint).data))
+
+        users_endpoint = '/api/books/' + self.first_book['isbn'] + '/users'
+        self.assertIn(self.user_one['email'], str(self.client().get(users_endpoint).data))
+        response = self.client().delete(endpoint + '/' + self.first_book['isbn'], headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.client().get(endpoint).data)['books'], [])
+        self.assertEqual(json.loads(self.client().get(users_endpoint).data)['users'], [])
+
+        # Verify counters are exposed
+        stats = json.loads(self.client().get('/api/cache').data)['cache']
+        self.assertEqual(stats['backend'], 'lru')
+        self.assertGreater(stats['misses'], 0)
+
+    # Test ETag / conditional GET support
+    def test_conditional_get(self):
+        # Add user, parse user ID, configure auth
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        user_one_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Verify an unchanged wishlist is answered with 304, with and without a cached copy
+        endpoint = '/api/users/' + user_one_id + '/books'
+        response = self.client().get(endpoint)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        response = self.client().get(endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        cache.clear()
+        response = self.client().get(endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Verify adding a book changes the wishlist ETag
+        response = self.client().post(endpoint, data=self.first_book, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        response = self.client().get(endpoint, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.first_book['isbn'], str(response.data))
+        etag = response.headers['ETag']
+
+        # Verify updating a book changes the book ETag and every wishlist containing it
+        book_endpoint = '/api/books/' + self.first_book['isbn']
+        book_etag = self.client().get(book_endpoint).headers['ETag']
+        self.assertEqual(self.client().get(book_endpoint, headers={'If-None-Match': book_etag}).status_code, 304)
+        book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+        response = self.client().put(endpoint + '/' + self.first_book['isbn'], data=book_update, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client().get(book_endpoint, headers={'If-None-Match': book_etag}).status_code, 200)
+        self.assertEqual(self.client().get(endpoint, headers={'If-None-Match': etag}).status_code, 200)
+
+        # Verify other reads get an ETag from their body
+        response = self.client().get('/api/users')
+        self.assertEqual(self.client().get('/api/users', headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+    # Test tuple serializers match the model serialize methods
+    def test_serializers(self):
+        self.client().post('/api/users', data=self.user_one)
+        self.client().post('/api/books', data=self.first_book)
+        self.client().post('/api/books', data=dict(self.second_book, pub_date='0999-01-02'))
+
+        with app.app_context():
+            self.assertEqual(serializers.books.dicts(serializers.books.query().order_by(BookModel.isbn)),
+                list(map(BookModel.serialize, BookModel.query.order_by(BookModel.isbn))))
+            self.assertEqual(serializers.users.dicts(serializers.users.query()),
+                list(map(UserModel.serialize, UserModel.query.all())))
+
+        # Verify the default backend encodes exactly as before and orjson decodes to the same listing
+        stdlib_response = self.client().get('/api/books')
+        self.assertEqual(stdlib_response.data, (json.dumps(json.loads(stdlib_response.data)) + '\n').encode('UTF-8'))
+        if serializers.orjson is not None:
+            try:
+                app.config['JSON_BACKEND'] = 'orjson'
+                orjson_response = self.client().get('/api/books')
+            finally:
+                app.config['JSON_BACKEND'] = 'json'
+            self.assertEqual(json.loads(stdlib_response.data), json.loads(orjson_response.data))
+
+    # Test SQLite performance profile and read-only pool
+    def test_sqlite_profile(self):
+        with app.app_context():
+            # Verify pragmas are applied to writer connections
+            self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+        # Verify GET requests read through query-only connections
+        with app.test_request_context('/api/books'):
+            self.assertIs(db.session.get_bind(), db.get_read_engine())
+            self.assertEqual(db.session.execute('PRAGMA query_only').scalar(), 1)
+            db.session.remove()
+        with app.test_request_context('/api/books', method='POST'):
+            self.assertIs(db.session.get_bind(), db.engine)
+            db.session.remove()
+
+    # Test new databases are stamped with the latest schema version and existing ones keep theirs
+    def test_migrations(self):
+        with app.app_context():
+            self.assertEqual(migrations.schema_version(db.engine), len(migrations.MIGRATIONS))
+            db.engine.execute('PRAGMA user_version = 1')
+            db.create_all()
+            self.assertEqual(migrations.schema_version(db.engine), 1)
+
+    # Test serving books from the in-memory catalog snapshot
+    def test_catalog(self):
+        for book in (self.first_book, self.third_book):
+            self.assertEqual(self.client().post('/api/books', data=book).status_code, 201)
+        paths = ['/api/books', '/api/books?limit=1', '/api/books?limit=1&after=' + self.first_book['isbn'],
+            '/api/books/' + self.first_book['isbn'], '/api/books/404',
+            '/api/books?isbn=404,' + self.third_book['isbn'] + ',' + self.first_book['isbn']]
+        expected = [(response.status_code, response.data) for response in map(self.client().get, paths)]
+
+        app.config.update(CATALOG_ENABLED=True, CATALOG_SNAPSHOT='test_catalog.snapshot')
+        try:
+            # Verify responses from the snapshot match the database
+            cache.clear()
+            self.assertEqual([(response.status_code, response.data) for response in map(self.client().get, paths)], expected)
+            self.assertTrue(os.path.exists('test_catalog.snapshot'))
+
+            # Verify new and updated books are visible as soon as they are committed
+            self.assertEqual(self.client().post('/api/books', data=self.second_book).status_code, 201)
+            with app.app_context():
+                upsert_book(self.first_book['isbn'], 'updated', self.first_book['author'], datetime(2018, 10, 16).date())
+                record_change('book', self.first_book['isbn'])
+                db.session.commit()
+                self.assertEqual(BookModel.query.get(self.first_book['isbn']).version, 2)
+            with app.test_request_context('/api/books'):
+                self.assertEqual(catalog.current().get(self.first_book['isbn'])[1], 'updated')
+            books = json.loads(self.client().get('/api/books').data)['books']
+            self.assertEqual([book['isbn'] for book in books], sorted([self.first_book['isbn'], self.second_book['isbn'],
+                self.third_book['isbn']]))
+            response = self.client().get('/api/books?limit=1&after=' + self.first_book['isbn'])
+            self.assertEqual(json.loads(response.data)['books'][0]['isbn'], min(self.second_book['isbn'], self.third_book['isbn']))
+
+            # Verify a book stamped long before its transaction committed is still picked up
+            with app.app_context():
+                db.session.add(BookModel(isbn='1000', title='late', author='late', pub_date=datetime(2018, 10, 16).date(),
+                    updated_at=datetime(2000, 1, 1)))
+                record_change('book', '1000')
+                db.session.commit()
+            self.assertEqual(json.loads(self.client().get('/api/books/1000').data)['book']['title'], 'late')
+
+            # Verify a catalog the pruned log no longer covers is replaced by a new snapshot
+            with app.app_context():
+                stale = catalog.current()
+                feed.prune(datetime.utcnow())
+                db.session.commit()
+            stale.watermark, stale.last_refresh = 0, 0.0
+            with app.test_request_context('/api/books'):
+                fresh = catalog.current()
+                self.assertIsNot(fresh, stale)
+                self.assertEqual(fresh.recent, ({}, []))
+                self.assertEqual(fresh.get('1000')[1], 'late')
+            self.assertEqual([name for name in os.listdir('.') if name.startswith('test_catalog.snapshot.')], [])
+        finally:
+            app.config.update(CATALOG_ENABLED=False)
+            catalog.reset()
+            if os.path.exists('test_catalog.snapshot'):
+                os.unlink('test_catalog.snapshot')
+
+    # Test upserted wishlist writes and Idempotency-Key replays
+    def test_idempotent_writes(self):
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Verify a PUT of a book already in the wishlist updates it instead of failing
+        endpoint = '/api/users/' + user_id + '/books/' + self.first_book['isbn']
+        book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+        for title in ('first', 'second'):
+            response = self.client().put(endpoint, data=dict(book_update, title=title), headers=headers)
+            self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            book = BookModel.query.get(self.first_book['isbn'])
+            self.assertEqual((book.title, book.version, book.wish_count), ('second', 2, 1))
+
+        # Verify a retried POST is answered from the first attempt, without a 409
+        retry_headers = dict(headers, **{'Idempotency-Key': 'add-second-book'})
+        endpoint = '/api/users/' + user_id + '/books'
+        first = self.client().post(endpoint, data=self.second_book, headers=retry_headers)
+        retry = self.client().post(endpoint, data=self.second_book, headers=retry_headers)
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.client().post(endpoint, data=self.second_book, headers=headers).status_code, 409)
+
+        # Verify reusing a key for a different request is rejected
+        response = self.client().post(endpoint, data=self.third_book, headers=retry_headers)
+        self.assertEqual(response.status_code, 422)
+
+    # Test /api/changes
+    def test_changes(self):
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_id = json.loads(user_post_response.data)['user']['user_id']
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+
+        # Add a book to the library, add one to the wishlist, update it and remove it
+        self.assertEqual(self.client().post('/api/books', data=self.first_book).status_code, 201)
+        endpoint = '/api/users/%d/books' % user_id
+        self.assertEqual(self.client().post(endpoint, data=self.second_book, headers=headers).status_code, 201)
+        book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+        endpoint = '/api/users/%d/books/%s' % (user_id, self.second_book['isbn'])
+        self.assertEqual(self.client().put(endpoint, data=book_update, headers=headers).status_code, 200)
+
+        # Verify every write was logged in order, with the book's current details
+        response = json.loads(self.client().get('/api/changes').data)
+        self.assertEqual([(change['kind'], change['isbn'], change['user_id']) for change in response['changes']], [
+            ('book', self.first_book['isbn'], None), ('book', self.second_book['isbn'], None),
+            ('add', self.second_book['isbn'], user_id), ('book', self.second_book['isbn'], None)])
+        self.assertEqual(response['changes'][-1]['book']['title'], 'updated')
+        self.assertEqual(response['next'], response['changes'][-1]['seq'])
+        self.assertEqual((response['oldest'], response['head']), (response['changes'][0]['seq'], response['next']))
+
+        # Verify paging with since and limit, and the per-user feed
+        page = json.loads(self.client().get('/api/changes?limit=1&since=%d' % response['changes'][0]['seq']).data)
+        self.assertEqual(page['changes'], response['changes'][1:2])
+        user_feed = json.loads(self.client().get('/api/changes?user_id=%d' % user_id).data)
+        self.assertEqual([change['seq'] for change in user_feed['changes']], [change['seq'] for change in response['changes'][1:]])
+
+        # Verify a long-poll returns as soon as a change is committed
+        delete = threading.Thread(target=lambda: (time.sleep(0.2), self.client().delete(endpoint, headers=headers)))
+        delete.start()
+        start = time.time()
+        waited = json.loads(self.client().get('/api/changes?wait=5&since=%d' % response['next']).data)
+        delete.join()
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual([(change['kind'], change['book']) for change in waited['changes']], [('remove', None)])
+        self.assertEqual(self.client().get('/api/changes?wait=0.1&since=%d' % waited['next']).status_code, 200)
+        for wait in ('nan', 'inf', '-inf', 'soon'):
+            self.assertEqual(self.client().get('/api/changes?wait=' + wait).status_code, 400)
+
+        # Verify clients behind the pruned log are told to resync
+        with app.app_context():
+            feed.prune(datetime.utcnow())
+            db.session.commit()
+        gone = self.client().get('/api/changes')
+        self.assertEqual(gone.status_code, 410)
+        self.assertEqual((json.loads(gone.data)['oldest'], json.loads(gone.data)['head']), (waited['next'], waited['next']))
+        resumed = json.loads(self.client().get('/api/changes?since=%d' % json.loads(gone.data)['head']).data)
+        self.assertEqual((resumed['changes'], resumed['next'], resumed['head']), ([], waited['next'], waited['next']))
+        self.assertEqual(self.client().get('/api/changes?since=x').status_code, 400)
+        # Verify a since beyond the head is rejected rather than echoed back
+        self.assertEqual(self.client().get('/api/changes?since=%d' % (waited['next'] + 1)).status_code, 400)
+
+    # Test wishlist writes through the group-commit write queue
+    def test_write_queue(self):
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_id = json.loads(user_post_response.data)['user']['user_id']
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        self.assertEqual(self.client().get('/api/token', headers=headers).status_code, 200)
+
+        app.config.update(WRITE_QUEUE_ENABLED=True, WRITE_BATCH_WINDOW=0.2)
+        try:
+            # Send adds of ten books, one of them twice, at once
+            books = [dict(self.first_book, isbn=str(1000 + i)) for i in range(10)] + [dict(self.first_book, isbn='1000')]
+            endpoint = '/api/users/%d/books' % user_id
+            statuses = []
+            batches = write_queue.batches
+            threads = [threading.Thread(target=lambda book=book: statuses.append(
+                self.client().post(endpoint, data=book, headers=headers).status_code)) for book in books]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # Verify they were committed together, and the duplicate was rejected without affecting the rest
+            self.assertEqual(sorted(statuses), [201] * 10 + [409])
+            self.assertLess(write_queue.batches - batches, len(books))
+            response = self.client().get(endpoint)
+            self.assertEqual(sorted(book['isbn'] for book in json.loads(response.data)['books']), [str(1000 + i) for i in range(10)])
+
+            # Verify updates, deletes and errors are answered as without the queue
+            endpoint = '/api/users/%d/books/1000' % user_id
+            book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+            self.assertEqual(self.client().put(endpoint, data=book_update, headers=headers).status_code, 200)
+            self.assertEqual(json.loads(self.client().get(endpoint).data)['book']['title'], 'updated')
+            self.assertEqual(self.client().delete(endpoint, headers=headers).status_code, 200)
+            self.assertEqual(self.client().delete(endpoint, headers=headers).status_code, 404)
+        finally:
+            app.config.update(WRITE_QUEUE_ENABLED=False, WRITE_BATCH_WINDOW=0.002)
+
+    # Test wishlist counts, the popular books ranking and reconciliation
+    def test_wish_count(self):
+        # Add both users, with the first book on both wishlists and the second on one
+        headers = {}
+        for user in (self.user_one, self.user_two):
+            user_post_response = self.client().post('/api/users', data=user)
+            user_id = str(json.loads(user_post_response.data)['user']['user_id'])
+            auth_creds = user['email'] + ':' + user['password']
+            headers[user_id] = {
+                'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+            }
+            response = self.client().post('/api/users/' + user_id + '/books', data=self.first_book, headers=headers[user_id])
+            self.assertEqual(response.status_code, 201)
+        response = self.client().put('/api/users/' + user_id + '/books/' + self.second_book['isbn'],
+            data=self.second_book, headers=headers[user_id])
+        self.assertEqual(response.status_code, 200)
+
+        # Verify counts and ranking
+        count_endpoint = '/api/books/' + self.first_book['isbn'] + '/users?count=true'
+        self.assertEqual(json.loads(self.client().get(count_endpoint).data)['count'], 2)
+        self.assertEqual(self.client().get('/api/books/404/users?count=true').status_code, 404)
+        books = json.loads(self.client().get('/api/books/popular?limit=5').data)['books']
+        self.assertEqual([(book['isbn'], book['wish_count']) for book in books],
+            [(self.first_book['isbn'], 2), (self.second_book['isbn'], 1)])
+        self.assertEqual(len(json.loads(self.client().get('/api/books/popular?limit=1').data)['books']), 1)
+        self.assertEqual(self.client().get('/api/books/popular?limit=0').status_code, 400)
+
+        # Verify deleting decrements the count
+        response = self.client().delete('/api/users/' + user_id + '/books/' + self.first_book['isbn'], headers=headers[user_id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.client().get(count_endpoint).data)['count'], 1)
+
+        # Verify reconciliation repairs drifted counts
+        with app.app_context():
+            db.session.execute(BookModel.__table__.update().values(wish_count=7))
+            self.assertEqual(reconcile_wish_counts(), 2)
+            self.assertEqual(reconcile_wish_counts(), 0)
+            db.session.commit()
+        self.assertEqual(json.loads(self.client().get(count_endpoint).data)['count'], 1)
+
+    # Test users and wishlists partitioned across two shards
+    def test_shards(self):
+        app.config['SHARD_COUNT'] = 2
+        shards.configure()
+        try:
+            with app.app_context():
+                shards.create_tables()
+
+            # Add three users; odd ids go to the second shard
+            headers = {}
+            for user in (self.user_one, self.user_two, dict(self.user_one, email='third@gmail.com')):
+                user_post_response = self.client().post('/api/users', data=user)
+                self.assertEqual(user_post_response.status_code, 201)
+                user_id = json.loads(user_post_response.data)['user']['user_id']
+                auth_creds = user['email'] + ':' + user['password']
+                headers[user_id] = {
+                    'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+                }
+            self.assertEqual(sorted(headers), [1, 2, 3])
+            self.assertEqual(self.client().post('/api/users', data=self.user_two).status_code, 409)
+            connection = sqlite3.connect(shards.database_path(1))
+            self.assertEqual([row[0] for row in connection.execute('SELECT id FROM users ORDER BY id')], [1, 3])
+            connection.close()
+
+            # Verify listings merge the shards
+            users = json.loads(self.client().get('/api/users').data)['users']
+            self.assertEqual([user['user_id'] for user in users], [1, 2, 3])
+            page = json.loads(self.client().get('/api/users?limit=2').data)
+            self.assertEqual(([user['user_id'] for user in page['users']], page['next']), ([1, 2], 2))
+            page = json.loads(self.client().get('/api/users?limit=2&after=2').data)
+            self.assertEqual(([user['user_id'] for user in page['users']], page['next']), ([3], None))
+            batch = json.loads(self.client().get('/api/users?id=3,9,2').data)
+            self.assertEqual(([user['user_id'] for user in batch['users']], batch['missing']), ([3, 2], [9]))
+            self.assertEqual(json.loads(self.client().get('/api/users/3').data)['user']['email'], 'third@gmail.com')
+
+            # Add the first book to users on both shards and verify its users are gathered from both
+            for user_id in (1, 2):
+                endpoint = '/api/users/%d/books' % user_id
+                response = self.client().post(endpoint, data=self.first_book, headers=headers[user_id])
+                self.assertEqual(response.status_code, 201)
+            book_users = '/api/books/' + self.first_book['isbn'] + '/users'
+            self.assertEqual([user['user_id'] for user in json.loads(self.client().get(book_users).data)['users']], [1, 2])
+            self.assertEqual(json.loads(self.client().get(book_users + '?count=true').data)['count'], 2)
+            self.assertEqual(self.client().post('/api/users/2/books', data=self.second_book, headers=headers[1]).status_code, 401)
+
+            # Verify an update shows up on the other shard's wishlist and a delete only affects one
+            book_update = {'title': 'updated', 'pub_date': '2018-10-10', 'author': 'updated'}
+            endpoint = '/api/users/1/books/' + self.first_book['isbn']
+            self.assertEqual(self.client().put(endpoint, data=book_update, headers=headers[1]).status_code, 200)
+            self.assertEqual(json.loads(self.client().get('/api/users/2/books').data)['books'][0]['title'], 'updated')
+            self.assertEqual(self.client().delete(endpoint, headers=headers[1]).status_code, 200)
+            self.assertEqual(json.loads(self.client().get('/api/users/1/books').data)['books'], [])
+            self.assertEqual([user['user_id'] for user in json.loads(self.client().get(book_users).data)['users']], [2])
+
+            changes = json.loads(self.client().get('/api/changes?user_id=1').data)['changes']
+            self.assertEqual([change['kind'] for change in changes], ['add', 'remove'])
+            with app.app_context():
+                self.assertEqual(reconcile_wish_counts(), 0)
+
+            # Verify a write queue batch commits its shard writes together with the rest, not one by one
+            def add_book(user_id):
+                db.session.execute("INSERT INTO user_books (user_id, isbn) VALUES (:user_id, '1000')", {'user_id': user_id})
+                return None, 201, []
+            def fail():
+                raise sqlite3.OperationalError('disk I/O error')
+            batch = [Operation(1, add_book, (1,)), Operation(1, add_book, (3,))]
+            commit, writer.commit = writer.commit, fail
+            try:
+                write_queue.apply(batch)
+            finally:
+                writer.commit = commit
+            self.assertIsInstance(batch[0].error, sqlite3.OperationalError)
+            connection = sqlite3.connect(shards.database_path(1))
+            self.assertEqual(connection.execute("SELECT count(*) FROM user_books WHERE isbn = '1000'").fetchone()[0], 0)
+            batch = [Operation(1, add_book, (1,)), Operation(1, add_book, (3,))]
+            write_queue.apply(batch)
+            self.assertEqual([operation.error for operation in batch], [None, None])
+            self.assertEqual(connection.execute("SELECT count(*) FROM user_books WHERE isbn = '1000'").fetchone()[0], 2)
+            connection.close()
+        finally:
+            with app.app_context():
+                db.session.remove()
+                db.dispose_engines()
+            app.config['SHARD_COUNT'] = 1
+            shards.configure()
+            for shard in (0, 1):
+                os.unlink(shards.database_path(shard))
+
+    # Test per-client rate limits and load shedding
+    def test_limits(self):
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        token = json.loads(self.client().get('/api/token', headers={
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }).data)['token']
+
+        app.config.update(RATE_LIMIT_ENABLED=True, RATE_LIMIT_RATE=1, RATE_LIMIT_BURST=60)
+        try:
+            # A full listing costs 50 of the 60 tokens, so a second one must wait
+            self.assertEqual(self.client().get('/api/users').status_code, 200)
+            response = self.client().get('/api/users')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '40')
+            # Paginated reads still fit, and the metrics endpoint is never limited
+            self.assertEqual(self.client().get('/api/users?limit=10').status_code, 200)
+            self.assertEqual(self.client().get('/metrics').status_code, 200)
+            # Token holders have their own bucket
+            headers = {'Authorization': 'Bearer ' + token}
+            self.assertEqual(self.client().get('/api/users', headers=headers).status_code, 200)
+            self.assertEqual(self.client().get('/api/users', headers=headers).status_code, 429)
+        finally:
+            app.config.update(RATE_LIMIT_ENABLED=False, RATE_LIMIT_RATE=20, RATE_LIMIT_BURST=200)
+            limits.buckets = limits.BucketTable(app.config['RATE_LIMIT_SLOTS'])
+
+        # Verify buckets are shared with forked processes
+        buckets = limits.BucketTable(64)
+        child = multiprocessing.get_context('fork').Process(target=buckets.take, args=('client', 5, 0.001, 5))
+        child.start()
+        child.join()
+        self.assertGreater(buckets.take('client', 1, 0.001, 5), 0)
+        self.assertEqual(buckets.take('other client', 5, 0.001, 5), 0)
+
+        # Verify requests are shed above the concurrency limit, and while latency is high
+        # unless nothing else is in flight
+        admission = limits.Admission()
+        self.assertTrue(admission.enter(2, 1.0))
+        self.assertTrue(admission.enter(2, 1.0))
+        self.assertFalse(admission.enter(2, 1.0))
+        admission.leave(10.0)
+        self.assertFalse(admission.enter(2, 1.0))
+        admission.leave(10.0)
+        self.assertTrue(admission.enter(2, 1.0))
+        app.config.update(ADMISSION_ENABLED=True, ADMISSION_MAX_IN_FLIGHT=0)
+        try:
+            response = self.client().get('/api/users')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            app.config.update(ADMISSION_ENABLED=False, ADMISSION_MAX_IN_FLIGHT=64)
+
+        # Verify long-polls are neither admitted nor timed, so they don't shed other requests
+        app.config.update(ADMISSION_ENABLED=True, ADMISSION_MAX_LATENCY=0.3)
+        try:
+            latency = limits.admission.latency
+            self.assertEqual(self.client().get('/api/changes?wait=0.5').status_code, 200)
+            self.assertEqual(limits.admission.latency, latency)
+            self.assertEqual(limits.admission.in_flight, 0)
+            self.assertEqual(self.client().get('/api/books').status_code, 200)
+            self.assertLess(limits.admission.latency, 0.3)
+        finally:
+            app.config.update(ADMISSION_ENABLED=False, ADMISSION_MAX_LATENCY=2.0)
+
+    # Test fetching many books or users in one request
+    def test_batch_get(self):
+        for book in (self.first_book, self.second_book):
+            self.assertEqual(self.client().post('/api/books', data=book).status_code, 201)
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_one_id = json.loads(user_post_response.data)['user']['user_id']
+
+        # Verify requested order is kept and unknown keys are reported
+        isbns = [self.second_book['isbn'], '404', self.first_book['isbn']]
+        response = self.client().get('/api/books?isbn=' + ','.join(isbns))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([book['isbn'] for book in data['books']], [isbns[0], isbns[2]])
+        self.assertEqual(data['missing'], ['404'])
+
+        data = json.loads(self.client().get('/api/users?id=%d,%d' % (user_one_id + 1, user_one_id)).data)
+        self.assertEqual([user['email'] for user in data['users']], [self.user_one['email']])
+        self.assertEqual(data['missing'], [user_one_id + 1])
+
+        # Verify invalid and oversized requests are rejected
+        self.assertEqual(self.client().get('/api/users?id=1,abc').status_code, 400)
+        self.assertEqual(self.client().get('/api/users?id=' + ','.join(map(str, range(1001)))).status_code, 400)
+
+    # Test request body parsing and normalization
+    def test_schemas(self):
+        # Verify missing fields are reported like reqparse errors
+        response = self.client().post('/api/books', data={'title': 'no isbn'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data), {'message': {'author': 'Author not provided'}})
+
+        # Verify JSON bodies are accepted and ISBNs are normalized
+        book = dict(self.first_book, isbn='978-0-306-40615-7', pub_date='2018-1-5')
+        response = self.client().post('/api/books', data=json.dumps(book), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['book']['isbn'], '9780306406157')
+        self.assertEqual(json.loads(response.data)['book']['pub_date'], '2018-01-05')
+        response = self.client().post('/api/books', data=dict(book, isbn='978 0306 40615 7'))
+        self.assertEqual(response.status_code, 409)
+
+        # Verify ISBNs that aren't digits with an optional trailing X are rejected
+        for isbn in ('---', 'X', '978-0-306-ABCDE'):
+            response = self.client().post('/api/books', data=dict(self.second_book, isbn=isbn))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)['message'], 'ISBN must be digits, optionally ending in X')
+        self.assertEqual(self.client().get('/api/books?isbn=89124,---').status_code, 400)
+
+        # Verify invalid dates are rejected
+        for pub_date in ('16/10/2018', '2018-02-30', '+2020-1-1', ' 2020-01-01', '20_20-01-01', '12020-01-01'):
+            response = self.client().post('/api/books', data=dict(self.second_book, pub_date=pub_date))
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('YYYY-mm-dd', json.loads(response.data)['message'])
+
+    # Test Server-Timing headers, /metrics and slow request profiling
+    def test_metrics(self):
+        # Verify each response reports its query count and timings
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        self.assertEqual(user_post_response.status_code, 201)
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        response = self.client().get('/api/token', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        server_timing = response.headers['Server-Timing']
+        self.assertRegex(server_timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertRegex(server_timing, r'auth;dur=[0-9.]+, serialize;dur=[0-9.]+, total;dur=[0-9.]+')
+
+        # Verify requests are aggregated per endpoint
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.data.decode('UTF-8')
+        self.assertIn('books_wishlist_requests_total{endpoint="token",method="GET",status="200"} 1', text)
+        self.assertIn('books_wishlist_request_duration_seconds_count{endpoint="users"} 1', text)
+        self.assertIn('# TYPE books_wishlist_sql_queries_total counter', text)
+
+        # Verify slow requests are profiled when enabled
+        profile_dir = app.config['PROFILE_DIR']
+        app.config.update(PROFILE_ENABLED=True, PROFILE_SAMPLE_RATE=1.0, PROFILE_THRESHOLD=0,
+            PROFILE_DIR='test_profiles')
+        try:
+            self.client().get('/api/books')
+            dumps = os.listdir('test_profiles')
+            self.assertEqual(len(dumps), 1)
+            self.assertIn('-GET-books-', dumps[0])
+        finally:
+            app.config.update(PROFILE_ENABLED=False, PROFILE_DIR=profile_dir)
+            for name in os.listdir('test_profiles'):
+                os.unlink(os.path.join('test_profiles', name))
+            os.rmdir('test_profiles')
+
+    # Test the production server's options and cache warmup
+    def test_server(self):
+        options = server.server_options(app.config)
+        self.assertTrue(options['preload_app'])
+        self.assertEqual(options['workers'], multiprocessing.cpu_count())
+
+        # Verify several workers bypass the in-process cache, so none serves stale data
+        self.assertFalse(server.bypass_local_cache(app.config, 1))
+        self.assertFalse(server.bypass_local_cache(dict(app.config, CACHE_BACKEND='redis'), 4))
+        cache.set('book:1', {'title': 'cached'})
+        try:
+            self.assertTrue(server.bypass_local_cache(app.config, 4))
+            cache.set('book:2', {'title': 'cached'})
+            self.assertEqual((cache.get('book:1'), cache.get('book:2')), (None, None))
+        finally:
+            cache.max_size = app.config['CACHE_MAX_SIZE']
+
+        # Add a book to a wishlist, verify warming caches it and its users
+        user_post_response = self.client().post('/api/users', data=self.user_one)
+        user_one_id = str(json.loads(user_post_response.data)['user']['user_id'])
+        auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+        headers = {
+            'Authorization': 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii')
+        }
+        response = self.client().post('/api/users/' + user_one_id + '/books', data=self.first_book, headers=headers)
+        self.assertEqual(response.status_code, 201)
+
+        cache.clear()
+        with app.app_context():
+            self.assertEqual(server.warm_cache(10), 1)
+        self.assertEqual(cache.get('book:' + self.first_book['isbn'])[0]['title'], self.first_book['title'])
+        self.assertEqual(cache.get('book_users:' + self.first_book['isbn'])[0]['email'], self.user_one['email'])
+
+    # Test the app is only loaded when needed, whichever module is imported first, and startup()
+    def test_startup(self):
+        import api
+        def run(code):
+            return subprocess.check_output([sys.executable, '-c', code],
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode('UTF-8').split()
+
+        self.assertEqual(run("import api, sys; print('flask' in sys.modules, 'app' in vars(api))"), ['False', 'False'])
+        self.assertEqual(run("import api.models, api; print(len(api.create_app().url_map._rules) > 10)"), ['True'])
+
+        self.assertIs(api.create_app(), app)
+        self.assertIs(api.startup(), app)
+        self.assertTrue(api.schema_ready)
+        response = self.client().get('/api/books')
+        self.assertEqual(response.status_code, 200)
+
+    # Test the ASGI entry point answers exactly like the Flask app
+    @unittest.skipUnless(asgi, 'aiosqlite and a2wsgi are not installed')
+    def test_asgi(self):
+        application = asgi.Application(app)
+
+        async def call(method, path, body=b'', headers=()):
+            path, _, query = path.partition('?')
+            headers = list(headers) + [('Host', 'localhost'), ('Content-Length', str(len(body)))]
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('UTF-8'),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+                'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'root_path': ''}
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            async def send(message):
+                messages.append(message)
+            await application(scope, receive, send)
+            body = b''.join(message.get('body', b'') for message in messages if message['type'] == 'http.response.body')
+            return messages[0]['status'], dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                for name, value in messages[0]['headers']), body
+
+        def flask_call(method, path, body=b'', headers=()):
+            response = self.client().open(path, method=method, data=body, headers=list(headers))
+            return response.status_code, dict((name.lower(), value) for name, value in response.headers), response.data
+
+        def assertSameResponse(asgi_response, flask_response):
+            self.assertEqual(asgi_response[0], flask_response[0])
+            self.assertEqual(asgi_response[2], flask_response[2])
+            for name in ('content-type', 'etag', 'last-modified'):
+                self.assertEqual(asgi_response[1].get(name), flask_response[1].get(name))
+
+        async def run():
+            try:
+                # Add a user through each app, verify the duplicate is rejected identically
+                form = [('Content-Type', 'application/x-www-form-urlencoded')]
+                status, headers, body = await call('POST', '/api/users', urlencode(self.user_one).encode('UTF-8'), form)
+                self.assertEqual(status, 201)
+                user_one_id = str(json.loads(body)['user']['user_id'])
+                assertSameResponse(await call('POST', '/api/users', urlencode(self.user_one).encode('UTF-8'), form),
+                    flask_call('POST', '/api/users', urlencode(self.user_one).encode('UTF-8'), form))
+                # Also when the duplicate gets past the email check, as a concurrent request can
+                async def missing(*args):
+                    return None
+                fetchone, application.db.fetchone = application.db.fetchone, missing
+                try:
+                    assertSameResponse(await call('POST', '/api/users', urlencode(self.user_one).encode('UTF-8'), form),
+                        flask_call('POST', '/api/users', urlencode(self.user_one).encode('UTF-8'), form))
+                finally:
+                    application.db.fetchone = fetchone
+                self.assertEqual(flask_call('POST', '/api/users', json.dumps(self.user_two).encode('UTF-8'),
+                    [('Content-Type', 'application/json')])[0], 201)
+
+                auth_creds = self.user_one['email'] + ':' + self.user_one['password']
+                auth = [('Authorization', 'Basic ' + b64encode(auth_creds.encode('UTF-8')).decode('ascii'))]
+                status, headers, body = await call('POST', '/api/users/' + user_one_id + '/books',
+                    urlencode(self.first_book).encode('UTF-8'), form + auth)
+                self.assertEqual(status, 201)
+
+                # Verify reads, pagination, conditional requests and errors match
+                for path in ('/api/users', '/api/users?limit=1', '/api/users?limit=1&after=1', '/api/users/' + user_one_id,
+                        '/api/users/99', '/api/books', '/api/books?limit=abc', '/api/books/' + self.first_book['isbn'],
+                        '/api/books/1', '/api/users/' + user_one_id + '/books', '/api/users/99/books',
+                        '/api/books/' + self.first_book['isbn'] + '/users', '/api/books?q=test'):
+                    cache.clear()
+                    flask_response = flask_call('GET', path)
+                    cache.clear()
+                    asgi_response = await call('GET', path)
+                    assertSameResponse(asgi_response, flask_response)
+                    assertSameResponse(await call('GET', path), flask_response)
+                    if 'etag' in flask_response[1]:
+                        conditional = [('If-None-Match', flask_response[1]['etag'])]
+                        self.assertEqual((await call('GET', path, headers=conditional))[0], 304)
+
+                # Verify async handlers are rate limited like the Flask app
+                app.config.update(RATE_LIMIT_ENABLED=True, RATE_LIMIT_RATE=1, RATE_LIMIT_BURST=60)
+                self.assertEqual((await call('GET', '/api/users'))[0], 200)
+                status, headers, body = await call('GET', '/api/users')
+                self.assertEqual((status, headers['retry-after']), (429, '40'))
+
+                # Verify they are subject to admission control too
+                app.config.update(RATE_LIMIT_ENABLED=False, ADMISSION_ENABLED=True, ADMISSION_MAX_IN_FLIGHT=0)
+                assertSameResponse(await call('GET', '/api/users'), flask_call('GET', '/api/users'))
+                self.assertEqual((await call('GET', '/api/users'))[1]['retry-after'], '1')
+            finally:
+                app.config.update(RATE_LIMIT_ENABLED=False, RATE_LIMIT_RATE=20, RATE_LIMIT_BURST=200,
+                    ADMISSION_ENABLED=False, ADMISSION_MAX_IN_FLIGHT=64)
+                limits.buckets = limits.BucketTable(app.config['RATE_LIMIT_SLOTS'])
+                await application.close()
+
+        asyncio.run(run())
+
     # Test user attempting to update another user's wishlist
     def test_unauthorized_access(self):
         # Add user, verify response and parse user ID
@@ -244,11 +1282,21 @@ class BooksWishlistTestCase(unittest.TestCase):
         post_response = self.client().post(endpoint, data=self.second_book, headers=headers)
         self.assertEqual(post_response.status_code, 401)
 
+        # Verify a signed-in user can't tell which books exist by deleting from another user's wishlist
+        self.client().post('/api/users', data=self.user_one)
+        for isbn in (self.second_book['isbn'], '404'):
+            delete_response = self.client().delete(endpoint + '/' + isbn, headers=headers)
+            self.assertEqual(delete_response.status_code, 401)
+
     # Delete temporary database
     def tearDown(self):
+        cache.clear()
+        registry.clear()
+        results.clear()
         with app.app_context():
             db.session.remove()
             db.drop_all()
+            db.dispose_engines()
             os.unlink(app.config['DATABASE'])
 
 if __name__ == "__main__":